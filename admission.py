@@ -0,0 +1,130 @@
+"""
+Admission control for the chat endpoints.
+
+A global in-flight limit with a bounded wait queue, plus a token bucket per
+user_id. Requests that can't be admitted are rejected straight away with a
+Retry-After hint instead of fanning out into more Gemini calls.
+
+Everything here runs on the event loop, so no locking is needed.
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted; maps to HTTP 429."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+class TokenBucketLimiter:
+    """
+    Per-key token buckets. Idle buckets are evicted LRU-first once more than
+    max_keys users are tracked, so memory stays bounded.
+    """
+
+    def __init__(self, rate_per_second: float, burst: int, max_keys: int = 10000):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, last_refill]
+
+    def try_acquire(self, key: str) -> float:
+        """
+        Take one token. Returns 0 if allowed, otherwise seconds until a token is available.
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [float(self.burst), now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.rate
+
+class AdmissionController:
+    """
+    Limits concurrent requests to max_in_flight. Up to max_queue more requests
+    wait at most queue_timeout seconds for a slot; beyond that they're rejected.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, queue_timeout: float,
+                 user_limiter: Optional[TokenBucketLimiter] = None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_limiter = user_limiter
+        self._slots = asyncio.Semaphore(max_in_flight)
+
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = {"rate_limited": 0, "queue_full": 0, "queue_timeout": 0}
+        self._queue_wait_total = 0.0
+        self._queue_wait_max = 0.0
+
+    @asynccontextmanager
+    async def admit(self, user_id: str):
+        if self.user_limiter is not None:
+            wait = self.user_limiter.try_acquire(user_id)
+            if wait > 0:
+                self.rejected["rate_limited"] += 1
+                raise AdmissionRejected("rate_limited", wait)
+
+        if not self._slots.locked():
+            # A free slot is taken synchronously, without queueing
+            await self._slots.acquire()
+        else:
+            if self.queued >= self.max_queue:
+                self.rejected["queue_full"] += 1
+                raise AdmissionRejected("queue_full", self.queue_timeout)
+
+            self.queued += 1
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected["queue_timeout"] += 1
+                raise AdmissionRejected("queue_timeout", self.queue_timeout)
+            finally:
+                self.queued -= 1
+
+            waited = time.monotonic() - start
+            self._queue_wait_total += waited
+            self._queue_wait_max = max(self._queue_wait_max, waited)
+        self.admitted += 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def metrics(self) -> Dict:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "queue_wait_avg_seconds": self._queue_wait_total / self.admitted if self.admitted else 0.0,
+            "queue_wait_max_seconds": self._queue_wait_max,
+        }
@@ -0,0 +1,142 @@
+"""
+Cold start benchmark: module import time and first-request latency.
+
+Every measurement runs in a fresh interpreter so nothing is cached between runs.
+
+Usage:
+    python benchmark_startup.py                # import time only
+    python benchmark_startup.py --first-request  # also hits Weaviate and Gemini
+    python benchmark_startup.py --first-request --offline
+
+--offline serves Weaviate from a local stub server and answers the Gemini RPC
+with a canned response, so SDK imports, client construction and connection
+setup are still timed but network round trips to the real services are not.
+--cold-only skips the prewarmed run, e.g. for code without warm_up().
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+IMPORT_SNIPPET = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+FIRST_REQUEST_SNIPPET = """
+import time
+import chatbot_service
+warm_up_time = 0.0
+if {prewarm}:
+    start = time.perf_counter()
+    chatbot_service.warm_up()
+    warm_up_time = time.perf_counter() - start
+start = time.perf_counter()
+chatbot_service.search_products_weaviate("süt", limit=5)
+# No product, price or greeting words, so the local classifier leaves it to Gemini
+chatbot_service.should_answer_question("Kahvaltıda ne yesem?")
+print(warm_up_time, time.perf_counter() - start)
+"""
+
+# Runs before chatbot_service is imported. The Gemini RPC is replaced as soon as
+# the SDK is imported, so the (lazy) import itself is still part of the timing.
+OFFLINE_PREFIX = """
+import importlib.abc, importlib.util, sys
+
+class _StubGeminiRPC(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path, target=None):
+        if name != "google.ai.generativelanguage":
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(name)
+        exec_module = spec.loader.exec_module
+
+        def exec_and_patch(module):
+            exec_module(module)
+            def generate_content(self, request=None, **kwargs):
+                part = module.Part(text="YES")
+                return module.GenerateContentResponse(candidates=[module.Candidate(content=module.Content(parts=[part]))])
+            module.GenerativeServiceClient.generate_content = generate_content
+
+        spec.loader.exec_module = exec_and_patch
+        return spec
+
+sys.meta_path.insert(0, _StubGeminiRPC())
+"""
+
+class StubWeaviateHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/chatbot/collections"):
+            body = {"collections": ["SupermarketProducts3"]}
+        else:
+            body = [{"name": f"Süt {i}", "price": 30 + i, "market_name": "Market"} for i in range(5)]
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_weaviate() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubWeaviateHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def run_snippet(snippet: str) -> str:
+    env = dict(os.environ)
+    # Import timing doesn't need a real key, only a non-empty one
+    env.setdefault("GEMINI_API_KEY", "benchmark")
+    result = subprocess.run(
+        [sys.executable, "-c", snippet],
+        capture_output=True, text=True, env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return result.stdout.strip().splitlines()[-1]
+
+def describe(samples):
+    return f"median {statistics.median(samples) * 1000:.1f} ms, min {min(samples) * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--first-request", action="store_true",
+                        help="measure first-request latency (needs GEMINI_API_KEY and Weaviate access)")
+    parser.add_argument("--offline", action="store_true",
+                        help="stub Weaviate and the Gemini RPC instead of calling the real services")
+    parser.add_argument("--cold-only", action="store_true", help="skip the prewarmed first-request run")
+    args = parser.parse_args()
+
+    for module in ("chatbot_service", "main"):
+        samples = [float(run_snippet(IMPORT_SNIPPET.format(module=module))) for _ in range(args.runs)]
+        print(f"import {module}: {describe(samples)}")
+
+    if args.first_request:
+        snippet = FIRST_REQUEST_SNIPPET
+        if args.offline:
+            snippet = OFFLINE_PREFIX + snippet.replace(
+                "import chatbot_service\n",
+                f"import chatbot_service\nimport weaviate_api\nweaviate_api.WEAVIATE_API_URL = {start_stub_weaviate()!r}\n", 1)
+        for prewarm in ((False,) if args.cold_only else (False, True)):
+            warm_samples, request_samples = [], []
+            for _ in range(args.runs):
+                warm, request = run_snippet(snippet.format(prewarm=prewarm)).split()
+                warm_samples.append(float(warm))
+                request_samples.append(float(request))
+            label = "prewarmed" if prewarm else "cold"
+            print(f"first request ({label}): {describe(request_samples)}")
+            if prewarm:
+                print(f"warm_up() in lifespan: {describe(warm_samples)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+Columnar, memory-mapped snapshot of the product catalogue.
+
+"Cheapest X" style questions only need name, price, market and category, so
+instead of semantic search + LLM ranking they can be answered from a local
+snapshot:
+
+    price.npy         float64[n]
+    market_id.npy     int32[n]   index into markets.json
+    category_id.npy   int32[n]   index into categories.json
+    name_offsets.npy  int64[n+1] byte offsets into names.bin
+    names.bin         UTF-8 product names, concatenated
+    key_offsets.npy   int64[n+1] byte offsets into keys.bin
+    keys.bin          Turkish-normalized names, one per line (used for matching)
+
+Every file is opened with mmap, so all workers on a host share one copy in the
+page cache. Workers notice a newly synced snapshot by meta.json's inode and mtime
+and reopen it on their next query. Build it with:
+
+    python catalogue_snapshot.py [collection] [snapshot_dir] [--force]
+
+A sync that hits a fetch error, or that finds far fewer products than the
+previous snapshot (below CATALOGUE_MIN_COUNT_RATIO of it, default 0.5), is
+aborted and the previous snapshot stays in place. --force skips the count check.
+"""
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import sys
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from turkish_text import INFLECTION_SUFFIXES, normalize_turkish
+from weaviate_api import DEFAULT_COLLECTION, WeaviateFetchError, iter_products
+from structured_logging import configure_logging, shutdown_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_DIR = os.environ.get("CATALOGUE_SNAPSHOT_DIR", "catalogue_snapshot")
+MATCH_CACHE_SIZE = 1024
+MIN_COUNT_RATIO = float(os.environ.get("CATALOGUE_MIN_COUNT_RATIO", "0.5"))
+SNAPSHOT_DIR_MODE = 0o755
+# Bytes read after a match: enough for the longest noun suffix (six letters,
+# two UTF-8 bytes each) and the character after it
+_SUFFIX_WINDOW = 16
+
+class SnapshotSyncError(Exception):
+    """Raised when a sync is aborted; the previous snapshot is left in place."""
+
+def _previous_count(snapshot_dir: str) -> Optional[int]:
+    try:
+        with open(os.path.join(snapshot_dir, "meta.json"), encoding="utf-8") as f:
+            return int(json.load(f)["count"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def sync_catalogue_snapshot(collection: str = DEFAULT_COLLECTION, snapshot_dir: str = DEFAULT_SNAPSHOT_DIR,
+                            force: bool = False) -> int:
+    """
+    Stream the whole collection and write a fresh snapshot to snapshot_dir.
+    The snapshot is built in a temporary directory and swapped in at the end,
+    so readers never see a half-written snapshot. Returns the product count.
+    Raises WeaviateFetchError or SnapshotSyncError without touching the current snapshot.
+    """
+    prices: List[float] = []
+    market_ids: List[int] = []
+    category_ids: List[int] = []
+    markets: Dict[str, int] = {}
+    categories: Dict[str, int] = {}
+    name_offsets = [0]
+    key_offsets = [0]
+
+    parent = os.path.dirname(os.path.abspath(snapshot_dir))
+    tmp_dir = tempfile.mkdtemp(prefix=".snapshot-", dir=parent)
+    try:
+        with open(os.path.join(tmp_dir, "names.bin"), "wb") as names_file, \
+             open(os.path.join(tmp_dir, "keys.bin"), "wb") as keys_file:
+            # Fetch errors must abort the sync, not end it early with a truncated catalogue
+            for product in iter_products(collection=collection, raise_errors=True):
+                try:
+                    price = float(product["price"])
+                except (KeyError, TypeError, ValueError):
+                    continue  # unpriced products can't answer price queries
+
+                name = str(product.get("name", ""))
+                market = str(product.get("market_name") or "")
+                category = str(product.get("main_category") or "")
+
+                name_bytes = name.encode("utf-8")
+                key_bytes = normalize_turkish(name).encode("utf-8") + b"\n"
+                names_file.write(name_bytes)
+                keys_file.write(key_bytes)
+                name_offsets.append(name_offsets[-1] + len(name_bytes))
+                key_offsets.append(key_offsets[-1] + len(key_bytes))
+
+                prices.append(price)
+                market_ids.append(markets.setdefault(market, len(markets)))
+                category_ids.append(categories.setdefault(category, len(categories)))
+
+        previous = _previous_count(snapshot_dir)
+        if not prices:
+            raise SnapshotSyncError(f"collection '{collection}' returned no priced products")
+        if not force and previous and len(prices) < previous * MIN_COUNT_RATIO:
+            raise SnapshotSyncError(
+                f"only {len(prices)} products, previous snapshot had {previous}; use force to accept"
+            )
+
+        np.save(os.path.join(tmp_dir, "price.npy"), np.asarray(prices, dtype=np.float64))
+        np.save(os.path.join(tmp_dir, "market_id.npy"), np.asarray(market_ids, dtype=np.int32))
+        np.save(os.path.join(tmp_dir, "category_id.npy"), np.asarray(category_ids, dtype=np.int32))
+        np.save(os.path.join(tmp_dir, "name_offsets.npy"), np.asarray(name_offsets, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, "key_offsets.npy"), np.asarray(key_offsets, dtype=np.int64))
+        with open(os.path.join(tmp_dir, "markets.json"), "w", encoding="utf-8") as f:
+            json.dump(list(markets), f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "categories.json"), "w", encoding="utf-8") as f:
+            json.dump(list(categories), f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"collection": collection, "count": len(prices)}, f)
+
+        # mkdtemp creates the directory as 0700; workers may run as another user
+        os.chmod(tmp_dir, SNAPSHOT_DIR_MODE)
+
+        # Swap the new snapshot in; open readers keep their mappings of the old files
+        old_dir = None
+        if os.path.exists(snapshot_dir):
+            old_dir = tempfile.mkdtemp(prefix=".snapshot-old-", dir=parent)
+            os.rmdir(old_dir)
+            os.rename(snapshot_dir, old_dir)
+        os.rename(tmp_dir, snapshot_dir)
+        if old_dir:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    logger.info("Wrote catalogue snapshot with %d products to '%s'", len(prices), snapshot_dir)
+    return len(prices)
+
+def _snapshot_version(snapshot_dir: str) -> Optional[Tuple[int, int]]:
+    """
+    Identity of the synced snapshot. Every sync writes a new meta.json and
+    renames its directory into place, so inode and mtime change together.
+    """
+    try:
+        stat = os.stat(os.path.join(snapshot_dir, "meta.json"))
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+def _map_bytes(path: str):
+    """Memory-map a file read-only; empty files can't be mapped."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class CatalogueSnapshot:
+    """
+    Read-only view over a snapshot directory. All arrays are memory-mapped.
+    """
+
+    def __init__(self, snapshot_dir: str = DEFAULT_SNAPSHOT_DIR):
+        self.snapshot_dir = snapshot_dir
+        self.version = _snapshot_version(snapshot_dir)
+        self.price = np.load(os.path.join(snapshot_dir, "price.npy"), mmap_mode="r")
+        self.market_id = np.load(os.path.join(snapshot_dir, "market_id.npy"), mmap_mode="r")
+        self.category_id = np.load(os.path.join(snapshot_dir, "category_id.npy"), mmap_mode="r")
+        self.name_offsets = np.load(os.path.join(snapshot_dir, "name_offsets.npy"), mmap_mode="r")
+        self.key_offsets = np.load(os.path.join(snapshot_dir, "key_offsets.npy"), mmap_mode="r")
+        self._names = _map_bytes(os.path.join(snapshot_dir, "names.bin"))
+        self._keys = _map_bytes(os.path.join(snapshot_dir, "keys.bin"))
+        with open(os.path.join(snapshot_dir, "markets.json"), encoding="utf-8") as f:
+            self.markets: List[str] = json.load(f)
+        with open(os.path.join(snapshot_dir, "categories.json"), encoding="utf-8") as f:
+            self.categories: List[str] = json.load(f)
+        self._match_cache: Dict[bytes, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.price)
+
+    def name(self, row: int) -> str:
+        start, end = self.name_offsets[row], self.name_offsets[row + 1]
+        return self._names[start:end].decode("utf-8")
+
+    def product(self, row: int) -> Dict:
+        return {
+            "name": self.name(row),
+            "price": float(self.price[row]),
+            "market_name": self.markets[self.market_id[row]],
+            "main_category": self.categories[self.category_id[row]],
+        }
+
+    def match(self, term: str) -> np.ndarray:
+        """
+        Row indices whose normalized name has the term at a word start, bare or
+        inflected ("süt", "sütü"), so "et" doesn't match "ketçap".
+        Scans the keys blob with mmap.find, so no names are decoded.
+        """
+        needle = normalize_turkish(term).encode("utf-8")
+        if not needle or not self._keys:
+            return np.empty(0, dtype=np.int64)
+        cached = self._match_cache.get(needle)
+        if cached is not None:
+            return cached
+
+        hits = []
+        pos = self._keys.find(needle)
+        while pos != -1:
+            if self._is_word_match(pos, pos + len(needle)):
+                hits.append(pos)
+            pos = self._keys.find(needle, pos + 1)
+
+        rows = np.searchsorted(self.key_offsets, np.asarray(hits, dtype=np.int64), side="right") - 1
+        rows = np.unique(rows)
+        rows.setflags(write=False)
+        if len(self._match_cache) >= MATCH_CACHE_SIZE:
+            self._match_cache.clear()
+        self._match_cache[needle] = rows
+        return rows
+
+    def _is_word_match(self, start: int, end: int) -> bool:
+        """
+        True if keys[start:end] starts a word and the rest of that word is empty
+        or an inflection; "sütlü çikolata" is not milk
+        """
+        if start > 0 and self._keys[start - 1:start] not in (b" ", b"\n"):
+            return False
+        tail = self._keys[end:end + _SUFFIX_WINDOW].decode("utf-8", "ignore")
+        rest = re.match(r"\w*", tail).group()
+        if len(rest) == len(tail):
+            return False  # the word runs past the window, longer than any suffix
+        return not rest or rest in INFLECTION_SUFFIXES
+
+    def _select(self, term: Optional[str], market: Optional[str]) -> np.ndarray:
+        rows = self.match(term) if term else np.arange(len(self), dtype=np.int64)
+        if market is not None and len(rows):
+            wanted = [i for i, name in enumerate(self.markets) if normalize_turkish(name) == normalize_turkish(market)]
+            rows = rows[np.isin(self.market_id[rows], wanted)]
+        return rows
+
+    def cheapest(self, term: Optional[str] = None, market: Optional[str] = None, k: int = 5) -> List[Dict]:
+        """
+        The k cheapest products matching the term, optionally within one market
+        """
+        rows = self._select(term, market)
+        if not len(rows):
+            return []
+        prices = self.price[rows]
+        if len(rows) > k:
+            top = np.argpartition(prices, k)[:k]
+            rows, prices = rows[top], prices[top]
+        return [self.product(int(row)) for row in rows[np.argsort(prices, kind="stable")]]
+
+    def cheapest_by_market(self, term: Optional[str] = None) -> Dict[str, Dict]:
+        """
+        The cheapest matching product in every market (group-by-market min)
+        """
+        rows = self._select(term, None)
+        if not len(rows):
+            return {}
+        # Sort by (market, price); the first row of each market group is its minimum
+        order = np.lexsort((self.price[rows], self.market_id[rows]))
+        rows = rows[order]
+        _, first = np.unique(self.market_id[rows], return_index=True)
+        return {self.markets[self.market_id[row]]: self.product(int(row)) for row in rows[first]}
+
+_snapshot: Optional[CatalogueSnapshot] = None
+
+def get_catalogue_snapshot(snapshot_dir: str = DEFAULT_SNAPSHOT_DIR) -> Optional[CatalogueSnapshot]:
+    """
+    Open the shared snapshot, reopening it when a newer one has been synced.
+    None if no snapshot has been synced yet.
+    """
+    global _snapshot
+    current = _snapshot if _snapshot is not None and _snapshot.snapshot_dir == snapshot_dir else None
+    version = _snapshot_version(snapshot_dir)
+    if version is None:
+        # Missing only for a moment while a sync swaps directories; keep serving the old mapping
+        return current
+    if current is None or current.version != version:
+        try:
+            _snapshot = CatalogueSnapshot(snapshot_dir)
+        except OSError as e:
+            logger.warning("Couldn't open catalogue snapshot '%s', retrying on next query: %s", snapshot_dir, e)
+            return current
+        logger.info("Opened catalogue snapshot '%s' with %d products", snapshot_dir, len(_snapshot))
+    return _snapshot
+
+if __name__ == "__main__":
+    configure_logging()
+    args = [arg for arg in sys.argv[1:] if arg != "--force"]
+    collection = args[0] if len(args) > 0 else DEFAULT_COLLECTION
+    target = args[1] if len(args) > 1 else DEFAULT_SNAPSHOT_DIR
+    try:
+        sync_catalogue_snapshot(collection, target, force="--force" in sys.argv[1:])
+    except (WeaviateFetchError, SnapshotSyncError) as e:
+        logger.error("Catalogue sync aborted, keeping the previous snapshot: %s", e)
+        shutdown_logging()
+        sys.exit(1)
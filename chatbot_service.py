@@ -1,35 +1,233 @@
-import requests
-import google.generativeai as genai
 import json
-import pandas as pd
-from typing import List, Dict, Optional, Tuple
+import logging
+import math
 import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List, Dict, Optional, Tuple
 
-# Configuration
-# Weaviate API Configuration
-USE_LOCAL_WEAVIATE = False  # Changed to False to use production
-LOCAL_WEAVIATE_URL = "http://127.0.0.1:8001"  # Local testing URL
-PRODUCTION_WEAVIATE_URL = "https://priceless-weaviate-production.up.railway.app"  # Production URL
+from profiling import stage
+from load_shedding import LEVEL_FULL, LEVEL_SKIP_ORGANIZE, LEVEL_LOCAL_RANKING, LEVEL_TEMPLATE_ANSWER
+from structured_logging import log_payload
+from query_classifier import QueryClassifier, DEFAULT_MODEL_PATH
+from turkish_text import INFLECTION_SUFFIXES, has_keyword, is_noun_form, normalize_turkish, split_words
+import weaviate_api
+from weaviate_api import (
+    DEFAULT_COLLECTION, WeaviateFetchError, get_http_session, submit_in_context,
+    search_products_weaviate, get_available_collections, iter_products
+)
+from llm_scheduler import (
+    LLMScheduler, begin_request, estimate_tokens,
+    PRIORITY_GENERATION, PRIORITY_RANKING, PRIORITY_CLASSIFICATION, PRIORITY_BACKGROUND
+)
+
+# NOTE: `google.generativeai` is imported lazily (see get_gemini_model), like
+# `requests` in weaviate_api. Importing them eagerly dominated cold
+# start on Render, where instances scale to zero.
 
-WEAVIATE_API_URL = LOCAL_WEAVIATE_URL if USE_LOCAL_WEAVIATE else PRODUCTION_WEAVIATE_URL
+logger = logging.getLogger(__name__)
 
-print(f"🔧 Using Weaviate API: {WEAVIATE_API_URL}")
+# Configuration
+# Collections searched together: comma-separated names, or "all" for every available collection
+SEARCH_COLLECTIONS = os.environ.get("SEARCH_COLLECTIONS", DEFAULT_COLLECTION)
+COLLECTION_SEARCH_TIMEOUT = float(os.environ.get("COLLECTION_SEARCH_TIMEOUT_SECONDS", "8"))
+COLLECTIONS_CACHE_TTL = float(os.environ.get("COLLECTIONS_CACHE_TTL_SECONDS", "300"))
+COLLECTIONS_RETRY_INTERVAL = float(os.environ.get("COLLECTIONS_RETRY_INTERVAL_SECONDS", "15"))
 
 # Configure Gemini API
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable is not set")
-genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
+
+# Max candidates passed to ranking after merging search results
+MAX_RANKING_CANDIDATES = 40
+
+# Gemini quota shared by all calls from this worker
+llm_scheduler = LLMScheduler(
+    requests_per_minute=int(os.environ.get("GEMINI_REQUESTS_PER_MINUTE", "500")),
+    tokens_per_minute=int(os.environ.get("GEMINI_TOKENS_PER_MINUTE", "1000000")),
+    max_wait=float(os.environ.get("GEMINI_QUEUE_MAX_WAIT_SECONDS", "30"))
+)
+
+# Speculative search: start Weaviate searches for likely product terms while LLM routing runs
+SPECULATIVE_SEARCH = os.environ.get("SPECULATIVE_SEARCH", "1") == "1"
+SEARCH_MAX_WORKERS = 8
+COLLECTION_SEARCH_MAX_WORKERS = 16
+
+# Local reranking: the LLM filter only runs when the local ranking is ambiguous,
+# i.e. kept and dropped candidates are closer than RERANK_LLM_MARGIN
+RERANK_MIN_SCORE = float(os.environ.get("RERANK_MIN_SCORE", "0.5"))
+RERANK_LLM_MARGIN = float(os.environ.get("RERANK_LLM_MARGIN", "0.15"))
+RERANK_WEIGHTS = {"lexical": 0.5, "semantic": 0.3, "head_noun": 0.3, "derived": -0.5}
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Shortest query term matched inside a closed compound ("yağ" in "zeytinyağı"),
+# and the shortest head before it, so "muz" doesn't match "domuz"
+COMPOUND_MIN_LENGTH = 3
+
+# Size and packaging tokens, ignored when finding a product's head noun
+UNIT_WORDS = {"l", "lt", "ml", "cl", "g", "gr", "kg", "adet", "x", "paket", "li", "lı", "lu", "lü"}
+
+# Words that turn a product into something made from it when they follow it
+# ("elma" -> "elma sirkesi"). Only right after a query term: in "Rize Çayı" the
+# possessive is the product itself.
+DERIVED_PRODUCT_WORDS = {
+    "sirkesi", "suyu", "reçeli", "kurusu", "püresi", "salçası", "sosu", "ezmesi",
+    "şurubu", "nektarı", "likörü", "çayı", "cipsi", "aromalı", "aromali", "kremalı",
+    "soslu", "dolgulu", "kaplamalı", "parçacıklı", "bisküvi", "gofret", "kek", "cips",
+    "içecek", "içeceği", "şeker"
+}
+
+# Per-user working set: products behind the last answer, reused by follow-up questions
+WORKING_SET_TTL = float(os.environ.get("WORKING_SET_TTL_SECONDS", "1800"))
+WORKING_SET_MAX_USERS = int(os.environ.get("WORKING_SET_MAX_USERS", "10000"))
+
+# Follow-up vocabulary: words that refer back to the last answer or ask for a
+# re-sort/re-filter. A follow-up may not contain other words unless they occur
+# in the working set, otherwise it mentions new products and goes to search.
+FOLLOW_UP_WORDS = {
+    "bu", "şu", "o", "bunlar", "bunları", "bunların", "bunlardan", "bunlarda", "bunu", "bunun",
+    "onlar", "onları", "onların", "onlardan", "şunlar", "şunların", "hangisi", "hangisinde",
+    "hangisinin", "hangisini", "hangileri", "hangi", "aynı", "ürün", "ürünü", "ürünler", "ürünleri",
+    "en", "daha", "fiyat", "fiyatı", "fiyatlar", "fiyatları", "fiyatlı", "kaç", "ne", "kadar",
+    "nedir", "mi", "mı", "mu", "mü", "var", "peki", "acaba", "ile", "ve", "tl", "lira", "nerede",
+    "göster", "sırala", "listele", "almalıyım", "alayım", "başka", "diğer", "farklı"
+}
+FOLLOW_UP_CHEAPEST = ("ucuz", "uygun")
+FOLLOW_UP_PRICIEST = ("pahalı",)
+FOLLOW_UP_OTHER = {"başka", "diğer", "farklı"}
+FOLLOW_UP_MARKET = ("market", "yer")
+
+_client_lock = threading.Lock()
+_gemini_model = None
+_search_executor = None
+_collection_executor = None
+
+_speculation_lock = threading.Lock()
+speculation_stats = {"started": 0, "searches": 0, "confirmed": 0, "rejected": 0, "hits": 0, "wasted": 0}
+
+_rerank_lock = threading.Lock()
+rerank_stats = {"local": 0, "llm_fallback": 0, "forced_local": 0}
+
+def get_gemini_model():
+    """
+    Return the shared Gemini model, importing and configuring the SDK on first use
+    """
+    global _gemini_model
+    if _gemini_model is None:
+        with _client_lock:
+            if _gemini_model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                _gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return _gemini_model
+
+def generate_content(prompt: str, priority: int):
+    """
+    Call Gemini once the shared quota scheduler grants the call
+    """
+    with stage("llm_queue"):
+        llm_scheduler.acquire(priority, estimate_tokens(prompt))
+    with stage("llm_call"):
+        return get_gemini_model().generate_content(prompt)
+
+def warm_up() -> Dict:
+    """
+    Prewarm the Gemini client, the Weaviate connection pool and the collections list.
+    Called from the FastAPI lifespan hook so the first user request doesn't pay for it.
+    Failures are reported, not raised: a cold component is still usable.
+    """
+    logger.info("Using Weaviate API: %s", weaviate_api.WEAVIATE_API_URL)
+    timings = {}
+    collections = []
+    
+    start = time.perf_counter()
+    try:
+        get_gemini_model()
+        # Creating the default client up front builds the gRPC channel once
+        from google.generativeai import client as genai_client
+        genai_client.get_default_generative_client()
+        timings["gemini"] = time.perf_counter() - start
+    except Exception as e:
+        logger.warning("Gemini warm-up failed: %s", e)
+    
+    start = time.perf_counter()
+    try:
+        # Opens a pooled connection to Weaviate and fetches the collections list
+        get_http_session()
+        collections = collection_registry.get(refresh=True)
+        timings["weaviate"] = time.perf_counter() - start
+    except Exception as e:
+        logger.warning("Weaviate warm-up failed: %s", e)
+    
+    logger.info("Warm-up finished: %s", ", ".join(f"{k}={v:.2f}s" for k, v in timings.items()))
+    return {"collections": collections, "timings": timings}
 
 # In-memory storage for summaries
 chat_summaries = {}
 
+class WorkingSetStore:
+    """
+    Last search terms, candidates and answer products per user, kept for ttl
+    seconds. At most max_users are kept, least recently used evicted first.
+    """
+    
+    def __init__(self, ttl: float, max_users: int, max_products: int = MAX_RANKING_CANDIDATES):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_products = max_products
+        self._lock = threading.Lock()
+        self._sets: "OrderedDict[str, Dict]" = OrderedDict()
+        self.stats = {"stored": 0, "follow_ups": 0, "expired": 0}
+    
+    def get(self, user_id: str) -> Optional[Dict]:
+        with self._lock:
+            working_set = self._sets.get(user_id)
+            if working_set is None:
+                return None
+            if time.monotonic() - working_set["updated"] > self.ttl:
+                del self._sets[user_id]
+                self.stats["expired"] += 1
+                return None
+            self._sets.move_to_end(user_id)
+            return working_set
+    
+    def put(self, user_id: str, search_terms: List[str], candidates: List[Dict], answer: List[Dict]) -> None:
+        with self._lock:
+            self._sets[user_id] = {
+                "search_terms": list(search_terms),
+                "candidates": candidates[:self.max_products],
+                "answer": answer[:self.max_products],
+                "updated": time.monotonic()
+            }
+            self._sets.move_to_end(user_id)
+            while len(self._sets) > self.max_users:
+                self._sets.popitem(last=False)
+            self.stats["stored"] += 1
+    
+    def record_follow_up(self) -> None:
+        with self._lock:
+            self.stats["follow_ups"] += 1
+    
+    def metrics(self) -> Dict:
+        with self._lock:
+            return {"users": len(self._sets), "ttl_seconds": self.ttl, **self.stats}
+
+working_sets = WorkingSetStore(ttl=WORKING_SET_TTL, max_users=WORKING_SET_MAX_USERS)
+
+@stage("classify")
 def should_answer_question(user_query: str, conversation_context: str = "") -> bool:
     """
     Step 1: Determine if we should answer this question at all
-    Uses LLM for accurate classification
+    Uses LLM for accurate classification, unless the local classifier is confident
     """
-    model = genai.GenerativeModel("gemini-2.0-flash")
+    words = re.findall(r"\w+", normalize_turkish(user_query))
+    decision = query_classifier.decide("answer", words, conversation_context)
+    if decision is not None:
+        return decision
     
     prompt = f"""
     You are a helpful assistant for a Turkish grocery shopping app.
@@ -48,18 +246,24 @@ def should_answer_question(user_query: str, conversation_context: str = "") -> b
     """
     
     try:
-        response = model.generate_content(prompt)
-        return "YES" in response.text.upper()
+        response = generate_content(prompt, PRIORITY_CLASSIFICATION)
+        decision = "YES" in response.text.upper()
+        query_classifier.record("answer", words, conversation_context, decision)
+        return decision
     except Exception as e:
-        print(f"Error in should_answer_question: {e}")
+        logger.error("Error in should_answer_question: %s", e)
         return True
 
+@stage("classify")
 def needs_product_search(user_query: str, conversation_context: str = "") -> bool:
     """
     Step 2: Determine if we need to search for products or can answer directly
-    Uses LLM for accurate decision making
+    Uses LLM for accurate decision making, unless the local classifier is confident
     """
-    model = genai.GenerativeModel("gemini-2.0-flash")
+    words = re.findall(r"\w+", normalize_turkish(user_query))
+    decision = query_classifier.decide("search", words, conversation_context)
+    if decision is not None:
+        return decision
     
     prompt = f"""
     You are a classification assistant for a Turkish shopping app.
@@ -80,19 +284,20 @@ def needs_product_search(user_query: str, conversation_context: str = "") -> boo
     """
     
     try:
-        response = model.generate_content(prompt)
-        return "YES" in response.text.upper()
+        response = generate_content(prompt, PRIORITY_CLASSIFICATION)
+        decision = "YES" in response.text.upper()
+        query_classifier.record("search", words, conversation_context, decision)
+        return decision
     except Exception as e:
-        print(f"Error in needs_product_search: {e}")
+        logger.error("Error in needs_product_search: %s", e)
         return True
 
+@stage("extract_terms")
 def extract_search_terms(user_query: str, conversation_context: str = "") -> List[str]:
     """
     Step 3: Extract product names/terms that need to be searched
     Uses LLM for accurate extraction with better prompting
     """
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    
     prompt = f"""
     Extract product names from this Turkish query and return ONLY a JSON array.
     
@@ -113,7 +318,7 @@ def extract_search_terms(user_query: str, conversation_context: str = "") -> Lis
     """
     
     try:
-        response = model.generate_content(prompt)
+        response = generate_content(prompt, PRIORITY_CLASSIFICATION)
         response_text = response.text.strip()
         
         # Extract JSON from response
@@ -126,28 +331,47 @@ def extract_search_terms(user_query: str, conversation_context: str = "") -> Lis
         
         extracted = json.loads(json_part)
         if isinstance(extracted, list) and extracted:
-            print(f"Successfully extracted terms: {extracted}")
+            logger.info("Extracted search terms: %s", extracted)
             return extracted
         else:
-            print(f"Empty extraction result, falling back to heuristic")
+            logger.info("Empty extraction result, falling back to heuristic")
             return extract_terms_heuristic(user_query, conversation_context)
             
     except Exception as e:
-        print(f"Error in extract_search_terms: {e}")
-        print(f"Response was: {response.text if 'response' in locals() else 'No response'}")
+        logger.error("Error in extract_search_terms: %s", e)
+        log_payload(logger, "Raw LLM response", response.text if 'response' in locals() else None)
         return extract_terms_heuristic(user_query, conversation_context)
 
+PRODUCT_KEYWORDS = [
+    'elma', 'muz', 'süt', 'ekmek', 'tavuk', 'et', 'sebze', 'meyve',
+    'domates', 'salatalık', 'patates', 'soğan', 'biber', 'havuç',
+    'peynir', 'yoğurt', 'tereyağ', 'makarna', 'pirinç', 'bulgur',
+    'çay', 'kahve', 'şeker', 'tuz', 'yağ', 'un', 'balık', 'kıyma',
+    'fasulye', 'nohut', 'mercimek', 'pilic', 'dana', 'kuzu'
+]
+
+# Routing decisions made locally (rules, memo, offline-trained model) before asking Gemini
+query_classifier = QueryClassifier(
+    product_keywords=PRODUCT_KEYWORDS,
+    model_path=DEFAULT_MODEL_PATH,
+    min_confidence=float(os.environ.get("CLASSIFIER_MIN_CONFIDENCE", "0.9")),
+    memo_size=int(os.environ.get("CLASSIFIER_MEMO_SIZE", "10000")),
+    memo_ttl=float(os.environ.get("CLASSIFIER_MEMO_TTL_SECONDS", "3600"))
+)
+
+def likely_product_terms(user_query: str) -> List[str]:
+    """
+    Product keywords the query uses as a noun ("elmalar" → elma), by the same
+    rule as the query classifier, so "yağmur" doesn't yield "yağ".
+    """
+    words = split_words(user_query)
+    return [keyword for keyword in PRODUCT_KEYWORDS if has_keyword(words, [keyword])]
+
 def extract_terms_heuristic(user_query: str, conversation_context: str = "") -> List[str]:
     """
     Fallback heuristic method to extract product terms
     """
-    product_keywords = [
-        'elma', 'muz', 'süt', 'ekmek', 'tavuk', 'et', 'sebze', 'meyve',
-        'domates', 'salatalık', 'patates', 'soğan', 'biber', 'havuç',
-        'peynir', 'yoğurt', 'tereyağ', 'makarna', 'pirinç', 'bulgur',
-        'çay', 'kahve', 'şeker', 'tuz', 'yağ', 'un', 'balık', 'kıyma',
-        'fasulye', 'nohut', 'mercimek', 'pilic', 'dana', 'kuzu'
-    ]
+    product_keywords = PRODUCT_KEYWORDS
     
     query_lower = user_query.lower()
     found_products = []
@@ -165,10 +389,10 @@ def extract_terms_heuristic(user_query: str, conversation_context: str = "") ->
     unique_products = list(set(found_products))
     
     if unique_products:
-        print(f"Heuristic extraction found: {unique_products}")
+        logger.info("Heuristic extraction found: %s", unique_products)
         return unique_products
     else:
-        print("No products found, using fallback search term")
+        logger.info("No products found, using fallback search term")
         if any(word in query_lower for word in ['fiyat', 'ne kadar', 'kaç para', 'ürün']):
             return ['meyve']
         return []
@@ -177,16 +401,256 @@ def search_products_api(search_term: str, top_k: int = 20) -> List[Dict]:
     """
     Step 4: Use Weaviate semantic search API only
     """
-    print(f"🔍 Searching Weaviate for: '{search_term}' (limit: {top_k})")
-    results = search_products_weaviate(search_term, limit=top_k)
+    logger.debug("Searching for '%s' (limit: %d)", search_term, top_k)
+    results = search_products_multi(search_term, limit=top_k)
     
     if results:
-        print(f"✅ Found {len(results)} products from Weaviate")
+        logger.info("Found %d products for '%s'", len(results), search_term)
         return results
     else:
-        print("❌ No results from Weaviate")
+        logger.info("No results for '%s'", search_term)
         return []
 
+class CollectionRegistry:
+    """
+    Caches the list of available Weaviate collections for ttl seconds.
+    A failed fetch keeps the last good list (or DEFAULT_COLLECTION if there is
+    none yet) and is retried after retry_interval seconds instead of the full ttl.
+    One thread refreshes an expired list while the others keep getting the cached one.
+    """
+    
+    def __init__(self, ttl: float, retry_interval: float):
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()  # guards the cached state, never held during a fetch
+        self._refresh_lock = threading.Lock()  # held by the thread fetching
+        self._collections: List[str] = []
+        self._fetched_at = 0.0
+        self._valid_for = 0.0
+        self.last_error: Optional[str] = None
+    
+    def _cached(self) -> Tuple[List[str], bool]:
+        with self._lock:
+            fresh = bool(self._collections) and time.monotonic() - self._fetched_at <= self._valid_for
+            return list(self._collections), fresh
+    
+    def get(self, refresh: bool = False) -> List[str]:
+        collections, fresh = self._cached()
+        if fresh and not refresh:
+            return collections
+        # Only callers with nothing cached, or forcing a refresh, wait for the fetch
+        if not self._refresh_lock.acquire(blocking=refresh or not collections):
+            return collections
+        try:
+            collections, fresh = self._cached()
+            if fresh and not refresh:
+                return collections  # refreshed while we waited
+            try:
+                fetched, error = get_available_collections(raise_errors=True), None
+            except WeaviateFetchError as e:
+                fetched, error = None, e
+            with self._lock:
+                if error is None:
+                    self._collections = fetched
+                    self._valid_for = self.ttl
+                    self.last_error = None
+                else:
+                    logger.warning("Keeping %s, retrying in %gs: %s",
+                                   "previous collections" if self._collections else "default collection",
+                                   self.retry_interval, error)
+                    self._collections = self._collections or [DEFAULT_COLLECTION]
+                    self._valid_for = self.retry_interval
+                    self.last_error = str(error)
+                self._fetched_at = time.monotonic()
+                return list(self._collections)
+        finally:
+            self._refresh_lock.release()
+
+collection_registry = CollectionRegistry(ttl=COLLECTIONS_CACHE_TTL, retry_interval=COLLECTIONS_RETRY_INTERVAL)
+
+def selected_collections() -> List[str]:
+    """
+    Collections that product searches fan out to
+    """
+    if SEARCH_COLLECTIONS.strip().lower() == "all":
+        return collection_registry.get()
+    return [name.strip() for name in SEARCH_COLLECTIONS.split(",") if name.strip()] or [DEFAULT_COLLECTION]
+
+def get_collection_executor():
+    """
+    Thread pool for per-collection searches. Kept separate from the search pool,
+    whose tasks wait on these, so nested waits can't exhaust one pool.
+    """
+    global _collection_executor
+    if _collection_executor is None:
+        with _client_lock:
+            if _collection_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _collection_executor = ThreadPoolExecutor(max_workers=COLLECTION_SEARCH_MAX_WORKERS, thread_name_prefix="collection")
+    return _collection_executor
+
+def normalize_scores(products: List[Dict], collection: str) -> List[Dict]:
+    """
+    Min-max normalize semantic scores within one collection's results so hits
+    from different collections are comparable. Returns annotated copies.
+    """
+    scores = [semantic_score(product) for product in products]
+    low, high = min(scores, default=0.0), max(scores, default=0.0)
+    span = high - low
+    return [
+        dict(product, collection=collection, search_score=(score - low) / span if span else 1.0)
+        for product, score in zip(products, scores)
+    ]
+
+@stage("search")
+def search_products_multi(search_term: str, collections: Optional[List[str]] = None, limit: int = 20) -> List[Dict]:
+    """
+    Search several collections concurrently and merge the results by normalized score.
+    A collection that doesn't answer within COLLECTION_SEARCH_TIMEOUT is left out.
+    """
+    from concurrent.futures import wait
+    
+    collections = collections or selected_collections()
+    executor = get_collection_executor()
+    futures = {
+        submit_in_context(executor, search_products_weaviate, search_term, collection, limit, COLLECTION_SEARCH_TIMEOUT): collection
+        for collection in collections
+    }
+    done, not_done = wait(futures, timeout=COLLECTION_SEARCH_TIMEOUT)
+    
+    for future in not_done:
+        future.cancel()
+        logger.warning("Search in collection '%s' timed out, skipping", futures[future])
+    
+    # Keep collection order for tie-breaking
+    results = [normalize_scores(future.result(), futures[future]) for future in futures if future in done]
+    return merge_products(results)
+
+def get_search_executor():
+    """
+    Shared thread pool for Weaviate searches running alongside other pipeline stages
+    """
+    global _search_executor
+    if _search_executor is None:
+        with _client_lock:
+            if _search_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS, thread_name_prefix="search")
+    return _search_executor
+
+class SpeculativeSearch:
+    """
+    Product searches started at the same time as LLM routing.
+    If routing confirms a product search, results for confirmed terms are reused;
+    anything left over is cancelled (or ignored if already running) on close().
+    """
+    
+    def __init__(self, terms: List[str]):
+        executor = get_search_executor()
+        self.futures = {
+            normalize_turkish(term): submit_in_context(executor, search_products_api, term, 20)
+            for term in terms
+        }
+        _record_speculation(started=1, searches=len(self.futures))
+    
+    def take(self, term: str):
+        """Future for a speculated term, or None if it wasn't speculated"""
+        future = self.futures.pop(normalize_turkish(term), None)
+        if future is not None:
+            _record_speculation(hits=1)
+        return future
+    
+    def close(self, confirmed: bool) -> None:
+        for future in self.futures.values():
+            future.cancel()
+        _record_speculation(confirmed=int(confirmed), rejected=int(not confirmed), wasted=len(self.futures))
+        self.futures = {}
+
+def _record_speculation(**counts) -> None:
+    with _speculation_lock:
+        for name, value in counts.items():
+            speculation_stats[name] += value
+
+def start_speculative_search(user_query: str) -> Optional[SpeculativeSearch]:
+    """
+    Start searching for likely product terms before routing finishes
+    """
+    if not SPECULATIVE_SEARCH:
+        return None
+    terms = likely_product_terms(user_query)
+    if not terms:
+        return None
+    logger.info("Speculatively searching for: %s", terms)
+    return SpeculativeSearch(terms)
+
+def speculation_metrics() -> Dict:
+    with _speculation_lock:
+        stats = dict(speculation_stats)
+    stats["hit_rate"] = stats["hits"] / stats["searches"] if stats["searches"] else 0.0
+    return stats
+
+def search_all_terms(search_terms: List[str], speculation: Optional[SpeculativeSearch] = None) -> List[List[Dict]]:
+    """
+    Search every term concurrently, reusing speculative searches where possible.
+    Returns one result list per term, in term order.
+    """
+    executor = get_search_executor()
+    futures = []
+    for term in search_terms:
+        future = speculation.take(term) if speculation else None
+        futures.append(future or submit_in_context(executor, search_products_api, term, 20))
+    return [future.result() for future in futures]
+
+def product_key(product: Dict) -> str:
+    """
+    Dedup key for a product: Turkish-normalized name and market
+    """
+    name = normalize_turkish(product.get('name', ''))
+    market = normalize_turkish(product.get('market_name') or '')
+    return f"{name}|{market}"
+
+def semantic_score(product: Dict) -> float:
+    """
+    Similarity score of a search hit; 0 for products that didn't come from search.
+    Prefers the per-collection normalized score set by search_products_multi.
+    """
+    additional = product.get('_additional') or {}
+    for field in ('search_score', 'score', 'certainty'):
+        value = product.get(field, additional.get(field))
+        if value is not None:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                pass
+    distance = product.get('distance', additional.get('distance'))
+    if distance is not None:
+        try:
+            return 1.0 - float(distance)
+        except (TypeError, ValueError):
+            pass
+    return 0.0
+
+@stage("merge")
+def merge_products(product_lists: Iterable[List[Dict]], max_candidates: int = MAX_RANKING_CANDIDATES) -> List[Dict]:
+    """
+    Merge search/knowledge-base results into one deduplicated candidate list.
+    Duplicates keep the copy with the best semantic score. The result is ordered by
+    score (first seen wins ties) and capped at max_candidates to bound the ranking prompt.
+    """
+    merged = {}  # key -> (score, first_seen, product)
+    for products in product_lists:
+        for product in products:
+            key = product_key(product)
+            score = semantic_score(product)
+            if key not in merged:
+                merged[key] = (score, len(merged), product)
+            elif score > merged[key][0]:
+                merged[key] = (score, merged[key][1], product)
+    
+    ranked = sorted(merged.values(), key=lambda entry: (-entry[0], entry[1]))
+    return [product for _, _, product in ranked[:max_candidates]]
+
+@stage("rank")
 def llm_filter_and_score_products(user_query: str, products: List[Dict], conversation_context: str = "") -> List[Dict]:
     """
     Step 5: Use LLM to intelligently filter, score and rank products
@@ -195,8 +659,6 @@ def llm_filter_and_score_products(user_query: str, products: List[Dict], convers
     if not products:
         return []
     
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    
     # Prepare product data for LLM analysis
     product_summaries = []
     for i, product in enumerate(products):
@@ -242,7 +704,7 @@ def llm_filter_and_score_products(user_query: str, products: List[Dict], convers
     """
     
     try:
-        response = model.generate_content(prompt)
+        response = generate_content(prompt, PRIORITY_RANKING)
         response_text = response.text.strip()
         
         # Extract JSON from response
@@ -265,15 +727,16 @@ def llm_filter_and_score_products(user_query: str, products: List[Dict], convers
             if 0 <= idx < len(products) and score >= 6:  # Only include good matches
                 relevant_products.append(products[idx])
         
-        print(f"LLM filtered to {len(relevant_products)} relevant products")
+        logger.info("LLM filtered to %d relevant products", len(relevant_products))
         return relevant_products[:15]  # More generous with results
         
     except Exception as e:
-        print(f"Error in LLM filtering: {e}")
-        print(f"Response was: {response.text if 'response' in locals() else 'No response'}")
+        logger.error("Error in LLM filtering: %s", e)
+        log_payload(logger, "Raw LLM response", response.text if 'response' in locals() else None)
         # More generous fallback - include more products
         return products[:12]
 
+@stage("organize")
 def llm_organize_for_response(user_query: str, products: List[Dict], conversation_context: str = "") -> Dict:
     """
     Step 6: Use LLM to organize products for optimal response generation
@@ -281,8 +744,6 @@ def llm_organize_for_response(user_query: str, products: List[Dict], conversatio
     if not products:
         return {"primary": [], "secondary": [], "response_type": "no_results"}
     
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    
     # Prepare product data
     product_summaries = []
     for i, product in enumerate(products):
@@ -327,9 +788,9 @@ def llm_organize_for_response(user_query: str, products: List[Dict], conversatio
     """
     
     try:
-        response = model.generate_content(prompt)
+        response = generate_content(prompt, PRIORITY_RANKING)
         response_text = response.text.strip()
-        print(f"LLM organization response: {response_text}")
+        log_payload(logger, "LLM organization response", response_text)
         
         # Extract JSON from response
         if '{' in response_text and '}' in response_text:
@@ -345,7 +806,7 @@ def llm_organize_for_response(user_query: str, products: List[Dict], conversatio
         primary_indices = organization.get('primary_products', [])
         secondary_indices = organization.get('secondary_products', [])
         
-        print(f"Primary indices: {primary_indices}, Secondary indices: {secondary_indices}")
+        logger.debug("Primary indices: %s, secondary indices: %s", primary_indices, secondary_indices)
         
         # Validate and filter indices
         valid_primary = [i for i in primary_indices if isinstance(i, int) and 0 <= i < len(products)]
@@ -360,25 +821,323 @@ def llm_organize_for_response(user_query: str, products: List[Dict], conversatio
         
         # Generous fallback: always provide helpful products
         if not organized_result['primary']:
-            print("No primary products selected, using generous fallback")
+            logger.info("No primary products selected, using generous fallback")
             organized_result['primary'] = products[:min(6, len(products))]
             organized_result['response_type'] = 'simple_answer'
             organized_result['strategy'] = 'by_relevance'
         
-        print(f"LLM organized: {len(organized_result['primary'])} primary, {len(organized_result['secondary'])} secondary")
+        logger.info("LLM organized: %d primary, %d secondary", len(organized_result['primary']), len(organized_result['secondary']))
         return organized_result
         
     except Exception as e:
-        print(f"Error in LLM organization: {e}")
-        print(f"Response was: {response.text if 'response' in locals() else 'No response'}")
+        logger.error("Error in LLM organization: %s", e)
+        log_payload(logger, "Raw LLM response", response.text if 'response' in locals() else None)
         # Generous fallback organization
-        return {
-            "primary": products[:min(6, len(products))],
-            "secondary": products[6:min(9, len(products))] if len(products) > 6 else [],
-            "response_type": "simple_answer",
-            "strategy": "by_relevance"
-        }
+        return organize_locally(products)
+
+def organize_locally(products: List[Dict]) -> Dict:
+    """
+    Organize products without the LLM: top 6 as primary, the next 3 as secondary
+    """
+    return {
+        "primary": products[:min(6, len(products))],
+        "secondary": products[6:min(9, len(products))] if len(products) > 6 else [],
+        "response_type": "simple_answer",
+        "strategy": "by_relevance"
+    }
+
+def format_product_lines(products: List[Dict]) -> str:
+    """
+    Markdown product lines in the format the chat UI expects
+    """
+    text = ""
+    for product in products:
+        market = product.get('market_name', 'bilinmeyen market')
+        text += f"* **{product['name']}** - {market} - {product['price']} TL\n"
+        if product.get('product_link'):
+            text += f"[Ürüne git]({product['product_link']})\n"
+        text += "\n"
+    return text
+
+def _price(product: Dict) -> float:
+    try:
+        return float(product.get('price'))
+    except (TypeError, ValueError):
+        return float('inf')
+
+@stage("template_answer")
+def render_template_answer(organized_products: Dict) -> str:
+    """
+    Answer without calling Gemini, used when load shedding skips generation
+    """
+    primary_products = sorted(organized_products.get('primary', []), key=_price)
+    secondary_products = organized_products.get('secondary', [])[:3]
+    
+    if not primary_products:
+        return "Üzgünüm, aradığınız ürünle ilgili bilgi bulamadım."
+    
+    response = "İşte bulduğum seçenekler (en ucuzdan pahalıya):\n\n" + format_product_lines(primary_products)
+    if secondary_products:
+        response += "Diğer seçenekler:\n\n" + format_product_lines(secondary_products)
+    return response.strip()
+
+def ranking_tokens(text: str) -> List[str]:
+    """
+    Normalized tokens of a product name or query, without sizes and units
+    """
+    tokens = re.findall(r"\w+", normalize_turkish(text))
+    return [token for token in tokens
+            if token not in UNIT_WORDS and not any(char.isdigit() for char in token)]
 
+def matches_term(word: str, term: str) -> bool:
+    """
+    True if the word is the term or an inflection of it ("çayı", "elmalar"), the
+    term is an inflection of the word, or the word is a closed compound ending
+    in the term ("zeytinyağı" for "yağ").
+    """
+    if is_noun_form(word, term, INFLECTION_SUFFIXES) or (len(word) > 1 and is_noun_form(term, word, INFLECTION_SUFFIXES)):
+        return True
+    if len(term) < COMPOUND_MIN_LENGTH:
+        return False
+    start = word.find(term, COMPOUND_MIN_LENGTH)
+    while start != -1:
+        rest = word[start + len(term):]
+        if not rest or rest in INFLECTION_SUFFIXES:
+            return True
+        start = word.find(term, start + 1)
+    return False
+
+def canonical_tokens(tokens: List[str], query_tokens: List[str]) -> List[str]:
+    """
+    Replace each token that matches a query token with that query token, so
+    BM25 counts "çayı" and "zeytinyağı" as hits for "çay" and "yağ"
+    """
+    return [next((term for term in query_tokens if matches_term(token, term)), token) for token in tokens]
+
+def bm25_scores(query_tokens: List[str], documents: List[List[str]]) -> List[float]:
+    """
+    BM25 of each document against the query, divided by the query's total IDF
+    so a document containing every query token once scores about 1
+    """
+    if not documents or not query_tokens:
+        return [0.0] * len(documents)
+    
+    avg_length = sum(len(doc) for doc in documents) / len(documents) or 1.0
+    idf = {}
+    for token in set(query_tokens):
+        containing = sum(1 for doc in documents if token in doc)
+        idf[token] = math.log(1 + (len(documents) - containing + 0.5) / (containing + 0.5))
+    max_score = sum(idf[token] for token in query_tokens)
+    
+    scores = []
+    for doc in documents:
+        score = 0.0
+        for token in query_tokens:
+            tf = doc.count(token)
+            if tf:
+                score += idf[token] * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * len(doc) / avg_length))
+        scores.append(min(1.0, score / max_score) if max_score else 0.0)
+    return scores
+
+def is_derived_product(name_tokens: List[str], query_tokens: List[str]) -> bool:
+    """
+    True if a query term is followed by a derived-product word the user didn't
+    ask for ("elma sirkesi", "çilekli bisküvi")
+    """
+    for word, next_word in zip(name_tokens, name_tokens[1:]):
+        if (next_word in DERIVED_PRODUCT_WORDS
+                and any(is_noun_form(word, term) or matches_term(word, term) for term in query_tokens)
+                and not any(matches_term(next_word, term) for term in query_tokens)):
+            return True
+    return False
+
+@stage("local_rank")
+def local_rerank_products(user_query: str, products: List[Dict], search_terms: List[str],
+                          limit: int = 15, keep_best: bool = False) -> Tuple[List[Dict], float]:
+    """
+    Rank products without the LLM by BM25 over name and category, semantic
+    score, head-noun match and a penalty for derived products.
+    Returns the kept products and the margin between the weakest kept and the
+    strongest dropped candidate (inf when nothing was dropped, 0 when nothing was kept).
+    With keep_best, the top `limit` candidates are kept when none clears the cutoff.
+    """
+    if not products:
+        return [], float('inf')
+    
+    query_tokens = [token for term in (search_terms or [user_query]) for token in ranking_tokens(term)]
+    query_heads = {ranking_tokens(term)[-1] for term in search_terms if ranking_tokens(term)}
+    derived_terms = list(dict.fromkeys(query_tokens + ranking_tokens(user_query)))
+    
+    raw_names = [ranking_tokens(product.get('name', '')) for product in products]
+    name_tokens = [canonical_tokens(tokens, query_tokens) for tokens in raw_names]
+    documents = [tokens + canonical_tokens(ranking_tokens(product.get('main_category') or ''), query_tokens)
+                 for tokens, product in zip(name_tokens, products)]
+    lexical = bm25_scores(query_tokens, documents)
+    
+    scored = []
+    for i, product in enumerate(products):
+        score = RERANK_WEIGHTS["lexical"] * lexical[i] + RERANK_WEIGHTS["semantic"] * min(1.0, max(0.0, semantic_score(product)))
+        if name_tokens[i] and name_tokens[i][-1] in query_heads:
+            score += RERANK_WEIGHTS["head_noun"]
+        if is_derived_product(raw_names[i], derived_terms):
+            score += RERANK_WEIGHTS["derived"]
+        scored.append((score, i))
+    scored.sort(key=lambda entry: (-entry[0], entry[1]))
+    
+    kept = [entry for entry in scored if entry[0] >= RERANK_MIN_SCORE][:limit]
+    dropped = scored[len(kept):]
+    if not kept:
+        margin = 0.0
+        if keep_best:
+            # Nothing for the LLM to rescue, so don't answer "not found" while search had hits
+            return [products[i] for _, i in scored[:limit]], margin
+    elif not dropped:
+        margin = float('inf')
+    else:
+        margin = kept[-1][0] - dropped[0][0]
+    return [products[i] for _, i in kept], margin
+
+def _record_rerank(name: str) -> None:
+    with _rerank_lock:
+        rerank_stats[name] += 1
+
+def rank_products(user_query: str, products: List[Dict], search_terms: List[str],
+                  conversation_context: str = "", allow_llm: bool = True) -> List[Dict]:
+    """
+    Step 5: Rank locally; ask the LLM only when the local margin is ambiguous
+    """
+    ranked, margin = local_rerank_products(user_query, products, search_terms, keep_best=not allow_llm)
+    if not allow_llm:
+        _record_rerank("forced_local")
+        return ranked
+    if margin >= RERANK_LLM_MARGIN:
+        _record_rerank("local")
+        logger.info("Local ranking kept %d products (margin %.2f)", len(ranked), margin)
+        return ranked
+    
+    _record_rerank("llm_fallback")
+    logger.info("Local ranking ambiguous (margin %.2f), using LLM filter", margin)
+    return llm_filter_and_score_products(user_query, products, conversation_context)
+
+def rerank_metrics() -> Dict:
+    with _rerank_lock:
+        stats = dict(rerank_stats)
+    decided = stats["local"] + stats["llm_fallback"]
+    stats["llm_fallback_rate"] = stats["llm_fallback"] / decided if decided else 0.0
+    return stats
+
+def follow_up_products(user_id: str, user_query: str) -> Optional[List[Dict]]:
+    """
+    Products answering a follow-up about the user's last answer ("en ucuzu hangisi?",
+    "bunlar başka markette ne kadar?", "yerli muzun en ucuzu"), re-filtered and
+    re-sorted locally. Returns None when the query isn't such a follow-up,
+    mentions new products or nothing in the working set matches.
+    """
+    working_set = working_sets.get(user_id)
+    if working_set is None:
+        return None
+    
+    answer, candidates = working_set["answer"], working_set["candidates"]
+    markets = {normalize_turkish(p.get('market_name') or '') for p in candidates} - {""}
+    term_tokens = [token for term in working_set["search_terms"] for token in ranking_tokens(term)]
+    known_tokens = {token for product in candidates for token in ranking_tokens(product.get('name', ''))}
+    known_tokens.update(term_tokens)
+    
+    def inflects(word: str, keywords: Iterable[str]) -> bool:
+        # "markette", "ucuzu", but not "yerli" or "yerfıstığı"
+        return any(is_noun_form(word, keyword, INFLECTION_SUFFIXES) for keyword in keywords)
+    
+    words = split_words(user_query)
+    cheapest = any(inflects(word, FOLLOW_UP_CHEAPEST) for word in words)
+    priciest = any(inflects(word, FOLLOW_UP_PRICIEST) for word in words)
+    other_markets = bool(FOLLOW_UP_OTHER & set(words)) and any(inflects(word, FOLLOW_UP_MARKET) for word in words)
+    mentioned_markets = {market for market in markets if any(inflects(word, [market.split()[0]]) for word in words)}
+    follow_up_keywords = FOLLOW_UP_CHEAPEST + FOLLOW_UP_PRICIEST + FOLLOW_UP_MARKET + tuple(
+        market.split()[0] for market in mentioned_markets)
+    
+    # Product words narrow the last answer ("yerli muz", "elma sirkesi"); unknown ones mean a new product
+    content_words = []
+    for word in words:
+        if word in FOLLOW_UP_WORDS or inflects(word, follow_up_keywords):
+            continue
+        if not any(matches_term(word, token) for token in known_tokens):
+            return None
+        content_words.append(word)
+    if not (cheapest or priciest or other_markets or mentioned_markets):
+        return None
+    narrowing = [word for word in content_words if not any(matches_term(word, token) for token in term_tokens)]
+    
+    shown = {product_key(product) for product in answer}
+    if narrowing:
+        # Dropped candidates too: "elma sirkesi" was ranked out of an answer about apples
+        pool = answer + [product for product in candidates if product_key(product) not in shown]
+    elif mentioned_markets or other_markets:
+        # Relevant candidates, not only the ones shown, so other markets can be offered
+        relevant, _ = local_rerank_products(user_query, candidates, working_set["search_terms"], limit=len(candidates))
+        pool = answer + [product for product in relevant if product_key(product) not in shown]
+    else:
+        pool = list(answer)
+    
+    products = [p for p in pool if all(any(matches_term(token, word) for token in ranking_tokens(p.get('name', '')))
+                                       for word in content_words)]
+    if mentioned_markets:
+        products = [p for p in products if normalize_turkish(p.get('market_name') or '') in mentioned_markets]
+    elif other_markets:
+        shown_markets = {normalize_turkish(p.get('market_name') or '') for p in answer}
+        products = [p for p in products if normalize_turkish(p.get('market_name') or '') not in shown_markets]
+    
+    if not products:
+        return None
+    if cheapest or priciest:
+        products.sort(key=_price, reverse=priciest and not cheapest)
+    working_sets.record_follow_up()
+    return products
+
+def answer_follow_up(user_id: str, user_query: str, products: List[Dict], conversation_context: str = "",
+                     degradation_level: int = LEVEL_FULL) -> str:
+    """
+    Answer a follow-up from the working set, skipping routing, term extraction and search
+    """
+    logger.info("Answering follow-up from working set (%d products)", len(products))
+    organized_products = organize_locally(products)
+    
+    working_set = working_sets.get(user_id)
+    if working_set is not None:
+        working_sets.put(user_id, working_set["search_terms"], working_set["candidates"],
+                         organized_products["primary"] + organized_products["secondary"])
+    
+    if degradation_level >= LEVEL_TEMPLATE_ANSWER:
+        return render_template_answer(organized_products)
+    return generate_intelligent_response(user_query, organized_products, conversation_context)
+
+def respond_with_products(user_query: str, candidates: List[Dict], search_terms: List[str],
+                          conversation_context: str = "", degradation_level: int = LEVEL_FULL,
+                          user_id: Optional[str] = None) -> str:
+    """
+    Steps 5-7: rank, organize and answer. Under load shedding, higher
+    degradation levels replace LLM stages with local ones.
+    The products are kept as the user's working set for follow-up questions.
+    """
+    # Step 5: Filtering and scoring
+    relevant_products = rank_products(user_query, candidates, search_terms, conversation_context,
+                                      allow_llm=degradation_level < LEVEL_LOCAL_RANKING)
+    
+    # Step 6: Organization for response
+    if degradation_level >= LEVEL_SKIP_ORGANIZE:
+        organized_products = organize_locally(relevant_products)
+    else:
+        organized_products = llm_organize_for_response(user_query, relevant_products, conversation_context)
+    
+    if user_id is not None:
+        working_sets.put(user_id, search_terms, candidates,
+                         organized_products.get('primary', []) + organized_products.get('secondary', []))
+    
+    # Step 7: Response
+    if degradation_level >= LEVEL_TEMPLATE_ANSWER:
+        return render_template_answer(organized_products)
+    return generate_intelligent_response(user_query, organized_products, conversation_context)
+
+@stage("generate")
 def generate_intelligent_response(user_query: str, organized_products: Dict, conversation_context: str = "") -> str:
     """
     Step 7: Generate intelligent response based on organized products
@@ -390,24 +1149,9 @@ def generate_intelligent_response(user_query: str, organized_products: Dict, con
     if not primary_products:
         return "Üzgünüm, aradığınız ürünle ilgili bilgi bulamadım."
     
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    
     # Format products for response
-    primary_text = ""
-    for product in primary_products:
-        market = product.get('market_name', 'bilinmeyen market')
-        primary_text += f"* **{product['name']}** - {market} - {product['price']} TL\n"
-        if product.get('product_link'):
-            primary_text += f"[Ürüne git]({product['product_link']})\n"
-        primary_text += "\n"
-    
-    secondary_text = ""
-    for product in secondary_products[:3]:  # Limit secondary products
-        market = product.get('market_name', 'bilinmeyen market')
-        secondary_text += f"* **{product['name']}** - {market} - {product['price']} TL\n"
-        if product.get('product_link'):
-            secondary_text += f"[Ürüne git]({product['product_link']})\n"
-        secondary_text += "\n"
+    primary_text = format_product_lines(primary_products)
+    secondary_text = format_product_lines(secondary_products[:3])  # Limit secondary products
     
     prompt = f"""
     You're a helpful Turkish shopping assistant creating a response.
@@ -439,10 +1183,10 @@ def generate_intelligent_response(user_query: str, organized_products: Dict, con
     """
     
     try:
-        response = model.generate_content(prompt)
+        response = generate_content(prompt, PRIORITY_GENERATION)
         return response.text.strip()
     except Exception as e:
-        print(f"Error generating intelligent response: {e}")
+        logger.error("Error generating intelligent response: %s", e)
         # Helpful fallback response
         if primary_products:
             cheapest = min(primary_products, key=lambda x: float(x['price']))
@@ -450,12 +1194,11 @@ def generate_intelligent_response(user_query: str, organized_products: Dict, con
             return f"* **{cheapest['name']}** - {market} - {cheapest['price']} TL\n[Ürüne git]({cheapest.get('product_link', '')})"
         return "Üzgünüm, şu anda yanıt oluşturamıyorum."
 
+@stage("general_answer")
 def answer_general_question(user_query: str, conversation_context: str = "") -> str:
     """
     Answer general questions without product search
     """
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    
     prompt = f"""
     You are a helpful Turkish shopping and food assistant.
     
@@ -471,218 +1214,81 @@ def answer_general_question(user_query: str, conversation_context: str = "") ->
     """
     
     try:
-        response = model.generate_content(prompt)
+        response = generate_content(prompt, PRIORITY_GENERATION)
         return response.text.strip()
     except Exception as e:
-        print(f"Error in general question: {e}")
+        logger.error("Error in general question: %s", e)
         return "Üzgünüm, şu anda bu soruya yanıt veremiyorum."
 
-def process_chat_message(user_query: str, conversation_context: str = "") -> str:
+def process_chat_message(user_query: str, conversation_context: str = "", degradation_level: int = LEVEL_FULL,
+                         user_id: Optional[str] = None) -> str:
     """
     Main function with completely LLM-powered intelligence
     """
-    print(f"Processing: {user_query}")
+    begin_request()
+    logger.info("Processing: %s", user_query)
     
-    # Step 1: Should we answer this question?
-    if not should_answer_question(user_query, conversation_context):
-        return "Üzgünüm, sadece yemek, market ve alışveriş ile ilgili sorularda yardımcı olabiliyorum."
-    
-    # Step 2: Do we need product search?
-    if not needs_product_search(user_query, conversation_context):
-        return answer_general_question(user_query, conversation_context)
+    # Follow-ups about the last answer are served from the user's working set
+    products = follow_up_products(user_id, user_query) if user_id is not None else None
+    if products is not None:
+        return answer_follow_up(user_id, user_query, products, conversation_context, degradation_level)
     
+    # Searches for obvious product terms run while the LLM decides on routing
+    speculation = start_speculative_search(user_query)
+    confirmed = False
     try:
+        # Step 1: Should we answer this question?
+        if not should_answer_question(user_query, conversation_context):
+            return "Üzgünüm, sadece yemek, market ve alışveriş ile ilgili sorularda yardımcı olabiliyorum."
+        
+        # Step 2: Do we need product search?
+        if not needs_product_search(user_query, conversation_context):
+            return answer_general_question(user_query, conversation_context)
+        confirmed = True
+        
         # Step 3: Extract search terms
         search_terms = extract_search_terms(user_query, conversation_context)
-        print(f"Search terms: {search_terms}")
+        logger.info("Search terms: %s", search_terms)
         
         # Step 4: Search for products (deduplicated)
-        seen_products = set()  # Track unique products
-        all_products = []
+        all_products = merge_products(search_all_terms(search_terms, speculation))
         
-        for term in search_terms:
-            products = search_products_api(term, top_k=20)
-            for product in products:
-                # Create a unique key for each product based on name and market
-                product_key = f"{product['name']}_{product['market_name']}"
-                if product_key not in seen_products:
-                    seen_products.add(product_key)
-                    all_products.append(product)
-        
-        print(f"Found {len(all_products)} unique products")
+        logger.info("Found %d unique products", len(all_products))
         
         if not all_products:
             return "Üzgünüm, aradığınız ürünlerle ilgili sonuç bulamadım."
         
-        # Step 5: LLM-powered intelligent filtering and scoring
-        relevant_products = llm_filter_and_score_products(user_query, all_products, conversation_context)
-        
-        # Step 6: LLM-powered organization for response
-        organized_products = llm_organize_for_response(user_query, relevant_products, conversation_context)
-        
-        # Step 7: Generate intelligent response
-        return generate_intelligent_response(user_query, organized_products, conversation_context)
+        # Steps 5-7: Filter, organize and answer (LLM stages may be shed under load)
+        return respond_with_products(user_query, all_products, search_terms, conversation_context, degradation_level, user_id)
         
     except Exception as e:
-        print(f"Error in process_chat_message: {e}")
+        logger.exception("Error in process_chat_message: %s", e)
         return f"Üzgünüm, bir hata oluştu: {str(e)}"
+    finally:
+        if speculation:
+            speculation.close(confirmed)
 
-def search_products_weaviate(search_term: str, collection: str = "SupermarketProducts3", limit: int = 20) -> List[Dict]:
-    """
-    Search products using Weaviate semantic search endpoint
-    """
-    url = f"{WEAVIATE_API_URL}/search"
-    params = {
-        "query": search_term,
-        "collection": collection,
-        "limit": limit
-    }
-    
-    print(f"🔍 Searching Weaviate for '{search_term}' in collection '{collection}'")
-    print(f"🔗 URL: {url}")
-    
-    try:
-        response = requests.get(url, params=params, timeout=30)  # Increased timeout
-        
-        if response.status_code == 200:
-            products = response.json()
-            if isinstance(products, list):
-                print(f"✅ Found {len(products)} products")
-                return products
-            else:
-                print("❌ Invalid response format")
-                return []
-        else:
-            print(f"❌ Search failed with status {response.status_code}")
-            print(f"Response: {response.text}")
-            return []
-            
-    except requests.exceptions.Timeout:
-        print("❌ Search request timed out")
-        return []
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Search request failed: {e}")
-        return []
-    except Exception as e:
-        print(f"❌ Unexpected error in search: {e}")
-        return []
-
-def get_products_from_weaviate(collection: str = "SupermarketProducts3", offset: int = 0, limit: int = 100) -> List[Dict]:
-    """
-    Get products from Weaviate collection using the chatbot endpoint
-    """
-    url = f"{WEAVIATE_API_URL}/chatbot/products"
-    params = {
-        "collection": collection,
-        "offset": offset,
-        "limit": limit
-    }
-    
-    print(f"📦 Fetching products from collection '{collection}'")
-    print(f"🔗 URL: {url}")
-    
-    try:
-        response = requests.get(url, params=params, timeout=30)  # Increased timeout
-        
-        if response.status_code == 200:
-            products = response.json()
-            if isinstance(products, list):
-                print(f"✅ Retrieved {len(products)} products")
-                return products
-            else:
-                print("❌ Invalid response format")
-                return []
-        else:
-            print(f"❌ Fetch failed with status {response.status_code}")
-            print(f"Response: {response.text}")
-            return []
-            
-    except requests.exceptions.Timeout:
-        print("❌ Product fetch request timed out")
-        return []
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Product fetch request failed: {e}")
-        return []
-    except Exception as e:
-        print(f"❌ Unexpected error in product fetch: {e}")
-        return []
-
-def get_available_collections() -> List[str]:
-    """
-    Get list of available Weaviate collections
-    """
-    url = f"{WEAVIATE_API_URL}/chatbot/collections"
-    print(f"📚 Fetching available collections")
-    print(f"🔗 URL: {url}")
-    
-    try:
-        response = requests.get(url, timeout=30)  # Increased timeout
-        
-        if response.status_code == 200:
-            data = response.json()
-            collections = data.get("collections", [])
-            if collections:
-                print(f"✅ Found collections: {collections}")
-                return collections
-            else:
-                print("❌ No collections found")
-                return ["SupermarketProducts3"]  # fallback
-        else:
-            print(f"❌ Collections fetch failed with status {response.status_code}")
-            print(f"Response: {response.text}")
-            return ["SupermarketProducts3"]  # fallback
-            
-    except requests.exceptions.Timeout:
-        print("❌ Collections request timed out")
-        return ["SupermarketProducts3"]  # fallback
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Collections request failed: {e}")
-        return ["SupermarketProducts3"]  # fallback
-    except Exception as e:
-        print(f"❌ Unexpected error in collections fetch: {e}")
-        return ["SupermarketProducts3"]  # fallback
-
-def get_product_knowledge_base(collection: str = "SupermarketProducts3", limit: int = 500) -> List[Dict]:
+@stage("knowledge_base")
+def get_product_knowledge_base(collection: str = DEFAULT_COLLECTION, limit: int = 500) -> List[Dict]:
     """
     Get a subset of products from Weaviate for RAG knowledge base
     Used to provide context to the LLM about available products
     """
     try:
-        # Get products in batches to avoid overwhelming the API
-        all_products = []
-        batch_size = 100
-        offset = 0
-        
-        while len(all_products) < limit:
-            batch = get_products_from_weaviate(
-                collection=collection, 
-                offset=offset, 
-                limit=min(batch_size, limit - len(all_products))
-            )
-            
-            if not batch:  # No more products
-                break
-                
-            all_products.extend(batch)
-            offset += batch_size
-            
-            if len(batch) < batch_size:  # Last batch
-                break
-        
-        print(f"Retrieved {len(all_products)} products for knowledge base")
+        all_products = list(iter_products(collection=collection, limit=limit))
+        logger.info("Retrieved %d products for knowledge base", len(all_products))
         return all_products
         
     except Exception as e:
-        print(f"Error building knowledge base: {e}")
+        logger.error("Error building knowledge base: %s", e)
         return []
 
+@stage("summary")
 def create_conversation_summary(messages: List[Dict], user_id: str) -> str:
     """Create a summary of conversation messages to preserve context while reducing tokens."""
     if not messages:
         return ""
     
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    
     # Convert messages to text format
     conversation_text = "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in messages)
     
@@ -701,12 +1307,13 @@ def create_conversation_summary(messages: List[Dict], user_id: str) -> str:
     """
     
     try:
-        response = model.generate_content(prompt)
+        response = generate_content(prompt, PRIORITY_BACKGROUND)
         return response.text.strip()
     except Exception as e:
-        print(f"Summary generation error: {e}")
+        logger.error("Summary generation error: %s", e)
         return f"Kullanıcı {len(messages)} mesajlık bir konuşma yaptı."
 
+@stage("history")
 def process_conversation_history(messages: List[Dict], user_id: str) -> Tuple[str, List[Dict]]:
     """
     Process conversation history and return context string and updated messages.
@@ -743,50 +1350,79 @@ def process_conversation_history(messages: List[Dict], user_id: str) -> Tuple[st
     
     return context, messages
 
-def enhanced_product_search_with_rag(user_query: str, conversation_history: List[Dict], user_id: str) -> str:
+def enhanced_product_search_with_rag(user_query: str, conversation_history: List[Dict], user_id: str,
+                                     degradation_level: int = LEVEL_FULL) -> str:
     """
     Enhanced version that uses both semantic search and knowledge base for better results
     Now accepts conversation_history as a list of message dictionaries
     """
-    print(f"Enhanced RAG search for: {user_query}")
-    
-    # Process conversation history and get context
-    context, updated_history = process_conversation_history(conversation_history, user_id)
-    
-    # Step 1: Should we answer this question?
-    if not should_answer_question(user_query, context):
-        return "Üzgünüm, sadece yemek, market ve alışveriş ile ilgili sorularda yardımcı olabiliyorum."
-    
-    # Step 2: Do we need product search?
-    if not needs_product_search(user_query, context):
-        return answer_general_question(user_query, context)
-    
-    # Step 3: Extract search terms
-    search_terms = extract_search_terms(user_query, context)
-    print(f"Search terms: {search_terms}")
+    begin_request()
+    logger.info("Enhanced RAG search for: %s", user_query)
+    
+    # Follow-ups about the last answer are served from the user's working set
+    products = follow_up_products(user_id, user_query)
+    if products is not None:
+        context, _ = process_conversation_history(conversation_history, user_id)
+        return answer_follow_up(user_id, user_query, products, context, degradation_level)
+    
+    # Searches for obvious product terms run while the LLM decides on routing
+    speculation = start_speculative_search(user_query)
+    confirmed = False
+    try:
+        # Process conversation history and get context
+        context, updated_history = process_conversation_history(conversation_history, user_id)
+        
+        # Step 1: Should we answer this question?
+        if not should_answer_question(user_query, context):
+            return "Üzgünüm, sadece yemek, market ve alışveriş ile ilgili sorularda yardımcı olabiliyorum."
+        
+        # Step 2: Do we need product search?
+        if not needs_product_search(user_query, context):
+            return answer_general_question(user_query, context)
+        confirmed = True
+        
+        # Step 3: Extract search terms
+        search_terms = extract_search_terms(user_query, context)
+        logger.info("Search terms: %s", search_terms)
+        
+        # Step 4: Get both search results and knowledge base
+        search_results = search_all_terms(search_terms, speculation)
+    finally:
+        if speculation:
+            speculation.close(confirmed)
     
-    # Step 4: Get both search results and knowledge base
-    search_results = []
-    for term in search_terms:
-        results = search_products_weaviate(term, limit=20)
-        search_results.extend(results)
+    found_count = sum(len(results) for results in search_results)
     
-    print(f"Found {len(search_results)} total products from search")
+    logger.info("Found %d total products from search", found_count)
     
     # Step 5: If search results are limited, supplement with knowledge base
-    if len(search_results) < 10:
-        print("Supplementing with knowledge base...")
-        knowledge_base = get_product_knowledge_base(limit=200)
+    if found_count < 10:
+        logger.info("Supplementing with knowledge base")
+        from concurrent.futures import wait
+        
+        executor = get_collection_executor()
+        knowledge_bases = {
+            submit_in_context(executor, get_product_knowledge_base, collection, 200): collection
+            for collection in selected_collections()
+        }
+        done, not_done = wait(knowledge_bases, timeout=COLLECTION_SEARCH_TIMEOUT)
+        for knowledge_base in not_done:
+            knowledge_base.cancel()
+            logger.warning("Knowledge base for collection '%s' timed out, skipping", knowledge_bases[knowledge_base])
         
         # Filter knowledge base by search terms
-        for product in knowledge_base:
-            product_name = product.get('name', '').lower()
-            if any(term.lower() in product_name for term in search_terms):
-                search_results.append(product)
-    
-    # Step 6: LLM filtering and organization
-    relevant_products = llm_filter_and_score_products(user_query, search_results, context)
-    organized_products = llm_organize_for_response(user_query, relevant_products, context)
-    
-    # Step 7: Generate response
-    return generate_intelligent_response(user_query, organized_products, context) 
\ No newline at end of file
+        normalized_terms = [normalize_turkish(term) for term in search_terms]
+        for knowledge_base in knowledge_bases:
+            if knowledge_base not in done:
+                continue
+            search_results.append([
+                product for product in knowledge_base.result()
+                if any(term in normalize_turkish(product.get('name', '')) for term in normalized_terms)
+            ])
+    
+    # Merge into one deduplicated, capped candidate list
+    candidates = merge_products(search_results)
+    logger.info("%d unique candidates after merge", len(candidates))
+    
+    # Steps 6-7: Filter, organize and answer (LLM stages may be shed under load)
+    return respond_with_products(user_query, candidates, search_terms, context, degradation_level, user_id) 
\ No newline at end of file
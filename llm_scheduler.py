@@ -0,0 +1,143 @@
+"""
+Quota-aware priority scheduler for Gemini calls.
+
+Every Gemini call asks the scheduler for permission first. Calls are granted
+within a requests-per-minute and tokens-per-minute budget. When the budget is
+exhausted they queue by priority class, and within a class by the start time
+of the chat request that made them. That way requests already in progress
+finish before new ones start using quota.
+"""
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+# Priority classes, most important first
+PRIORITY_GENERATION = 0
+PRIORITY_RANKING = 1
+PRIORITY_CLASSIFICATION = 2
+PRIORITY_BACKGROUND = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_GENERATION: "generation",
+    PRIORITY_RANKING: "ranking",
+    PRIORITY_CLASSIFICATION: "classification",
+    PRIORITY_BACKGROUND: "background",
+}
+
+_request_started = contextvars.ContextVar("llm_request_started", default=None)
+
+def begin_request() -> None:
+    """
+    Mark the start of a chat request on the current thread; its LLM calls
+    are ordered by this timestamp within their priority class.
+    """
+    _request_started.set(time.monotonic())
+
+def estimate_tokens(prompt: str, expected_output_tokens: int = 256) -> int:
+    """Rough token estimate (~4 characters per token) plus room for the output."""
+    return len(prompt) // 4 + expected_output_tokens
+
+class LLMQueueTimeout(Exception):
+    """Raised when a call waited longer than max_wait for quota."""
+
+class LLMScheduler:
+    """
+    Grants LLM calls within a sliding one-minute budget, in priority order.
+    Thread-safe: the pipeline runs in FastAPI's threadpool.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_wait: float = 30.0, window: float = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_wait = max_wait
+        self.window = window
+
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (priority, request_started, seq)
+        self._seq = itertools.count()
+        self._granted = deque()  # (granted_at, tokens) within the window
+        self._granted_tokens = 0
+
+        self._stats = {
+            name: {"calls": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+
+    def _seconds_until_budget(self, tokens: int, now: float) -> float:
+        while self._granted and now - self._granted[0][0] >= self.window:
+            _, expired = self._granted.popleft()
+            self._granted_tokens -= expired
+
+        if not self._granted:
+            return 0.0  # an oversized call still runs when nothing else is in the window
+        if len(self._granted) < self.requests_per_minute and self._granted_tokens + tokens <= self.tokens_per_minute:
+            return 0.0
+        return self.window - (now - self._granted[0][0])
+
+    def acquire(self, priority: int, tokens: int) -> float:
+        """
+        Block until the call may run. Returns the time spent queued.
+        Raises LLMQueueTimeout after max_wait seconds.
+        """
+        started = _request_started.get()
+        queued_at = time.monotonic()
+        entry = (priority, started if started is not None else queued_at, next(self._seq))
+        deadline = queued_at + self.max_wait
+        stats = self._stats[PRIORITY_NAMES[priority]]
+
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._waiting[0] is entry:
+                        wait = self._seconds_until_budget(tokens, now)
+                        if wait <= 0:
+                            break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        stats["timeouts"] += 1
+                        raise LLMQueueTimeout(f"waited {self.max_wait:g}s for LLM quota")
+                    self._cond.wait(remaining if wait is None else min(wait, remaining))
+
+                heapq.heappop(self._waiting)
+                self._granted.append((now, tokens))
+                self._granted_tokens += tokens
+
+                waited = now - queued_at
+                stats["calls"] += 1
+                stats["wait_total"] += waited
+                stats["wait_max"] = max(stats["wait_max"], waited)
+                return waited
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                # The head of the queue changed; let the next caller re-check
+                self._cond.notify_all()
+
+    def metrics(self) -> Dict:
+        with self._cond:
+            self._seconds_until_budget(0, time.monotonic())
+            return {
+                "queue_depth": len(self._waiting),
+                "requests_in_window": len(self._granted),
+                "tokens_in_window": self._granted_tokens,
+                "requests_per_minute": self.requests_per_minute,
+                "tokens_per_minute": self.tokens_per_minute,
+                "by_priority": {
+                    name: {
+                        "calls": s["calls"],
+                        "timeouts": s["timeouts"],
+                        "queue_wait_avg_seconds": s["wait_total"] / s["calls"] if s["calls"] else 0.0,
+                        "queue_wait_max_seconds": s["wait_max"],
+                    }
+                    for name, s in self._stats.items()
+                },
+            }
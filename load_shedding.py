@@ -0,0 +1,105 @@
+"""
+Adaptive load shedding of optional pipeline stages.
+
+The controller turns load (in-flight + queued requests relative to capacity)
+and recent stage latencies into one pressure number. As pressure rises, it
+switches optional stages off in this order:
+
+    1  skip llm_organize_for_response (products organized locally)
+    2  also replace llm_filter_and_score_products with local ranking
+    3  also render a template answer instead of generate_intelligent_response
+
+A higher level applies as soon as pressure crosses its threshold. Stages come
+back one level at a time, once pressure has stayed clearly below the current
+level's threshold for the cooldown period.
+"""
+import time
+from typing import Dict, List, Optional
+
+from profiling import stage_latencies
+
+LEVEL_FULL = 0
+LEVEL_SKIP_ORGANIZE = 1
+LEVEL_LOCAL_RANKING = 2
+LEVEL_TEMPLATE_ANSWER = 3
+
+LEVEL_NAMES = {
+    LEVEL_FULL: "full",
+    LEVEL_SKIP_ORGANIZE: "skip_organize",
+    LEVEL_LOCAL_RANKING: "local_ranking",
+    LEVEL_TEMPLATE_ANSWER: "template_answer",
+}
+
+# Stage latency (seconds) that counts as pressure 1.0
+DEFAULT_LATENCY_TARGETS = {
+    "llm_queue": 2.0,
+    "classify": 2.0,
+    "rank": 4.0,
+    "organize": 4.0,
+    "generate": 6.0,
+}
+
+class LoadShedder:
+    """
+    Runs on the event loop; update() is called once per admitted chat request.
+    """
+
+    def __init__(self, thresholds: List[float], latency_targets: Optional[Dict[str, float]] = None,
+                 cooldown: float = 10.0, recovery_margin: float = 0.8, enabled: bool = True):
+        self.thresholds = sorted(thresholds)[:LEVEL_TEMPLATE_ANSWER]
+        self.latency_targets = latency_targets or DEFAULT_LATENCY_TARGETS
+        self.cooldown = cooldown
+        self.recovery_margin = recovery_margin
+        self.enabled = enabled
+
+        self.level = LEVEL_FULL
+        self.pressure = 0.0
+        self._changed_at = 0.0
+        self._responses = {name: 0 for name in LEVEL_NAMES.values()}
+        self._transitions = 0
+
+    def _pressure(self, load: int, capacity: int) -> float:
+        pressure = load / capacity if capacity else 0.0
+        for name, latency in stage_latencies().items():
+            target = self.latency_targets.get(name)
+            if target:
+                pressure = max(pressure, latency / target)
+        return pressure
+
+    def update(self, load: int, capacity: int) -> int:
+        """
+        Re-evaluate pressure and return the degradation level for a new request.
+        """
+        if not self.enabled:
+            self._responses[LEVEL_NAMES[LEVEL_FULL]] += 1
+            return LEVEL_FULL
+
+        now = time.monotonic()
+        self.pressure = self._pressure(load, capacity)
+        target = sum(1 for threshold in self.thresholds if self.pressure >= threshold)
+
+        if target > self.level:
+            self.level = target
+            self._changed_at = now
+            self._transitions += 1
+        elif (self.level > LEVEL_FULL
+              and self.pressure < self.thresholds[self.level - 1] * self.recovery_margin
+              and now - self._changed_at >= self.cooldown):
+            self.level -= 1
+            self._changed_at = now
+            self._transitions += 1
+
+        self._responses[LEVEL_NAMES[self.level]] += 1
+        return self.level
+
+    def metrics(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "level": self.level,
+            "level_name": LEVEL_NAMES[self.level],
+            "pressure": round(self.pressure, 3),
+            "thresholds": self.thresholds,
+            "transitions": self._transitions,
+            "responses_by_level": dict(self._responses),
+            "stage_latency_seconds": {name: round(value, 3) for name, value in stage_latencies().items()},
+        }
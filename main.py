@@ -1,12 +1,36 @@
-from fastapi import FastAPI
+import asyncio
+import hmac
+import json
+import logging
+import os
+import uuid
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, Query
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from chatbot_service import process_chat_message, enhanced_product_search_with_rag, get_available_collections, get_product_knowledge_base
-import google.generativeai as genai
-from typing import List, Dict
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from chatbot_service import process_chat_message, enhanced_product_search_with_rag, collection_registry, DEFAULT_COLLECTION, iter_products, create_conversation_summary, warm_up, llm_scheduler, speculation_metrics, rerank_metrics, working_sets, query_classifier
+from admission import AdmissionController, AdmissionRejected, TokenBucketLimiter
+from load_shedding import LoadShedder, LEVEL_FULL
+from profiling import SamplingProfiler, profile_current_thread
+from structured_logging import configure_logging, shutdown_logging, request_context, dropped_records
+from typing import Optional
 
-app = FastAPI()
+configure_logging()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Prewarm clients before the app reports ready, so the first request after
+    a scale-from-zero doesn't pay for SDK imports and connection setup.
+    """
+    await run_in_threadpool(warm_up)
+    yield
+    shutdown_logging()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,41 +40,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Admission control: global in-flight limit with a bounded queue, per-user rate limits
+admission = AdmissionController(
+    max_in_flight=int(os.environ.get("CHAT_MAX_IN_FLIGHT", "8")),
+    max_queue=int(os.environ.get("CHAT_MAX_QUEUE", "32")),
+    queue_timeout=float(os.environ.get("CHAT_QUEUE_TIMEOUT_SECONDS", "10")),
+    user_limiter=TokenBucketLimiter(
+        rate_per_second=float(os.environ.get("CHAT_USER_RATE_PER_MINUTE", "20")) / 60,
+        burst=int(os.environ.get("CHAT_USER_BURST", "5"))
+    )
+)
+
+# Optional LLM stages are switched off progressively as load rises
+load_shedder = LoadShedder(
+    thresholds=[float(t) for t in os.environ.get("LOAD_SHED_THRESHOLDS", "0.75,1.0,1.5").split(",")],
+    enabled=os.environ.get("LOAD_SHEDDING", "1") == "1"
+)
+
+# Profiling is opt-in: the endpoint and per-request profiles need this token
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN")
+MAX_PROFILE_SECONDS = 60
+
 # In-memory storage for conversation context
 user_conversations = {}
 user_summaries = {}
 
-def create_conversation_summary(messages: List[Dict], user_id: str) -> str:
-    """Create a summary of conversation messages to preserve context while reducing tokens."""
-    if not messages:
-        return ""
-    
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    
-    # Convert messages to text format
-    conversation_text = "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in messages)
-    
-    prompt = f"""
-    You are helping to summarize a conversation between a user and a Turkish shopping assistant.
-    
-    Please create a concise summary of the following conversation that preserves:
-    - Product names or categories the user has asked about
-    - Any preferences they've expressed (price ranges, stores, etc.)
-    - Important context that might be relevant for future questions
-    
-    Conversation to summarize:
-    {conversation_text}
-    
-    Create a brief summary in Turkish that captures the essential context. Keep it under 100 words.
-    """
-    
-    try:
-        response = model.generate_content(prompt)
-        return response.text.strip()
-    except Exception as e:
-        print(f"Summary generation error: {e}")
-        return f"Kullanıcı {len(messages)} mesajlık bir konuşma yaptı."
-
 def get_conversation_context(user_id: str, window_size: int = 5) -> str:
     """Get conversation context with summary of older messages."""
     if user_id not in user_conversations:
@@ -81,13 +95,43 @@ def get_conversation_context(user_id: str, window_size: int = 5) -> str:
 class ChatRequest(BaseModel):
     user_id: str
     message: str
+    profile: bool = False  # attach a stage-tagged profile (needs X-Profiling-Token)
+
+def profiling_allowed(token: Optional[str]) -> bool:
+    """Profiling is disabled unless PROFILING_TOKEN is set, and then needs that token."""
+    return bool(PROFILING_TOKEN) and token is not None and hmac.compare_digest(token, PROFILING_TOKEN)
 
 @app.get("/")
 def root():
     return {"message": "Chatbot API is running with RAG approach."}
 
+def too_many_requests(rejection: AdmissionRejected) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={
+            "response": "Şu anda çok fazla istek var, lütfen biraz sonra tekrar deneyin.",
+            "error": rejection.reason
+        },
+        headers={"Retry-After": rejection.retry_after_header},
+        media_type="application/json; charset=utf-8"
+    )
+
 @app.post("/chat")
-def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, x_profiling_token: Optional[str] = Header(None),
+                        x_request_id: Optional[str] = Header(None)):
+    try:
+        async with admission.admit(request.user_id):
+            profile = request.profile and profiling_allowed(x_profiling_token)
+            request_id = x_request_id or uuid.uuid4().hex[:16]
+            level = load_shedder.update(load=admission.in_flight + admission.queued, capacity=admission.max_in_flight)
+            with request_context(request_id):
+                response = await run_in_threadpool(handle_chat, request, profile, level)
+            response.headers["X-Request-ID"] = request_id
+            return response
+    except AdmissionRejected as rejection:
+        return too_many_requests(rejection)
+
+def handle_chat(request: ChatRequest, profile: bool = False, degradation_level: int = LEVEL_FULL) -> JSONResponse:
     user_input = request.message
     user_id = request.user_id
 
@@ -105,7 +149,8 @@ def chat_endpoint(request: ChatRequest):
             context += f"{msg['role'].upper()}: {msg['content']}\n"
         
         # Process the message using new RAG approach
-        response = process_chat_message(user_input, context)
+        with profile_current_thread(profile) as profiler:
+            response = process_chat_message(user_input, context, degradation_level, user_id)
         
         # Update conversation history
         conversation_history.append({"role": "user", "content": user_input})
@@ -117,18 +162,35 @@ def chat_endpoint(request: ChatRequest):
         else:
             user_conversations[user_id] = conversation_history
 
-        return JSONResponse(content={"response": response}, media_type="application/json; charset=utf-8")
+        content = {"response": response, "degradation_level": degradation_level}
+        if profiler:
+            content["profile"] = profiler.folded()
+        return JSONResponse(content=content, media_type="application/json; charset=utf-8")
     
     except Exception as e:
         error_response = f"Üzgünüm, bir hata oluştu: {str(e)}"
-        print(f"Error in chat endpoint: {e}")
+        logger.exception("Error in chat endpoint: %s", e)
         return JSONResponse(content={"response": error_response}, media_type="application/json; charset=utf-8")
 
 @app.post("/chat-enhanced")
-def enhanced_chat_endpoint(request: ChatRequest):
+async def enhanced_chat_endpoint(request: ChatRequest, x_profiling_token: Optional[str] = Header(None),
+                                 x_request_id: Optional[str] = Header(None)):
     """
     Enhanced chatbot endpoint using RAG with Weaviate knowledge base
     """
+    try:
+        async with admission.admit(request.user_id):
+            profile = request.profile and profiling_allowed(x_profiling_token)
+            request_id = x_request_id or uuid.uuid4().hex[:16]
+            level = load_shedder.update(load=admission.in_flight + admission.queued, capacity=admission.max_in_flight)
+            with request_context(request_id):
+                response = await run_in_threadpool(handle_enhanced_chat, request, profile, level)
+            response.headers["X-Request-ID"] = request_id
+            return response
+    except AdmissionRejected as rejection:
+        return too_many_requests(rejection)
+
+def handle_enhanced_chat(request: ChatRequest, profile: bool = False, degradation_level: int = LEVEL_FULL) -> JSONResponse:
     user_input = request.message
     user_id = request.user_id
 
@@ -140,11 +202,13 @@ def enhanced_chat_endpoint(request: ChatRequest):
         conversation_history = user_conversations[user_id]
         
         # Process using enhanced RAG approach with conversation history
-        response = enhanced_product_search_with_rag(
-            user_query=user_input,
-            conversation_history=conversation_history,
-            user_id=user_id
-        )
+        with profile_current_thread(profile) as profiler:
+            response = enhanced_product_search_with_rag(
+                user_query=user_input,
+                conversation_history=conversation_history,
+                user_id=user_id,
+                degradation_level=degradation_level
+            )
         
         # Update conversation history
         conversation_history.append({"role": "user", "content": user_input})
@@ -153,45 +217,120 @@ def enhanced_chat_endpoint(request: ChatRequest):
         # Store updated history
         user_conversations[user_id] = conversation_history
 
+        content = {"response": response, "degradation_level": degradation_level}
+        if profiler:
+            content["profile"] = profiler.folded()
         return JSONResponse(
-            content={"response": response},
+            content=content,
             media_type="application/json; charset=utf-8"
         )
     
     except Exception as e:
         error_response = f"Üzgünüm, bir hata oluştu: {str(e)}"
-        print(f"Error in enhanced chat endpoint: {e}")
+        logger.exception("Error in enhanced chat endpoint: %s", e)
         return JSONResponse(
             content={"response": error_response},
             media_type="application/json; charset=utf-8"
         )
 
+@app.get("/metrics")
+def get_metrics_endpoint():
+    """
+    Queue depth, in-flight, rejection, LLM queue wait and speculation counters
+    """
+    return {
+        "admission": admission.metrics(),
+        "llm_scheduler": llm_scheduler.metrics(),
+        "speculation": speculation_metrics(),
+        "reranking": rerank_metrics(),
+        "working_sets": working_sets.metrics(),
+        "classification": query_classifier.metrics(),
+        "load_shedding": load_shedder.metrics(),
+        "logging": {"dropped_records": dropped_records()}
+    }
+
+@app.get("/debug/profile")
+async def profile_endpoint(seconds: float = 10, interval: float = 0.005, include_idle: bool = False,
+                           x_profiling_token: Optional[str] = Header(None)):
+    """
+    Sample every thread of this worker for N seconds and return folded stacks,
+    ready for flamegraph.pl or speedscope
+    """
+    if not profiling_allowed(x_profiling_token):
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+    
+    profiler = SamplingProfiler(interval=max(interval, 0.001), include_idle=include_idle).start()
+    try:
+        await asyncio.sleep(min(max(seconds, 0), MAX_PROFILE_SECONDS))
+    finally:
+        profiler.stop()
+    return PlainTextResponse(
+        profiler.folded(),
+        headers={"X-Profile-Samples": str(profiler.samples), "X-Profile-Duration": f"{profiler.duration:.3f}"}
+    )
+
 @app.get("/collections")
-def get_collections_endpoint():
+def get_collections_endpoint(refresh: bool = False):
     """
-    Get available Weaviate collections
+    Get available Weaviate collections (cached; refresh=true forces a refetch)
     """
     try:
-        collections = get_available_collections()
+        collections = collection_registry.get(refresh=refresh)
+        if collection_registry.last_error:
+            # Serving the last good (or default) list while Weaviate is failing
+            return {"collections": collections, "stale": True, "error": collection_registry.last_error}
         return {"collections": collections}
     except Exception as e:
-        print(f"Error getting collections: {e}")
+        logger.exception("Error getting collections: %s", e)
         return {"collections": [], "error": str(e)}
 
 @app.get("/knowledge-base")
-def get_knowledge_base_endpoint(collection: str = "SupermarketProducts3", limit: int = 100):
+def get_knowledge_base_endpoint(collection: str = DEFAULT_COLLECTION, limit: int = 100, stream: bool = False):
     """
-    Get products from knowledge base for testing
+    Get products from knowledge base for testing.
+    With stream=true, all products are returned as NDJSON while pages arrive.
     """
+    if stream:
+        def ndjson_lines():
+            for product in iter_products(collection=collection, limit=limit):
+                yield json.dumps(product, ensure_ascii=False) + "\n"
+        
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson; charset=utf-8")
+    
     try:
-        products = get_product_knowledge_base(collection, limit)
+        # Only the first 10 are displayed, so count the rest without keeping them
+        products = []
+        total_retrieved = 0
+        for product in iter_products(collection=collection, limit=limit):
+            if len(products) < 10:
+                products.append(product)
+            total_retrieved += 1
+        
         return {
             "collection": collection,
-            "count": len(products),
-            "products": products[:10] if products else [],  # Return first 10 for display
-            "total_retrieved": len(products)
+            "count": total_retrieved,
+            "products": products,  # Return first 10 for display
+            "total_retrieved": total_retrieved
         }
     except Exception as e:
-        print(f"Error getting knowledge base: {e}")
+        logger.exception("Error getting knowledge base: %s", e)
+        return {"products": [], "error": str(e)}
+
+@app.get("/catalogue/cheapest")
+def get_cheapest_endpoint(q: str = "", market: str = None, k: int = Query(5, ge=1, le=100), by_market: bool = False):
+    """
+    Answer "cheapest X" queries from the local memory-mapped catalogue snapshot
+    """
+    # Imported here so workers that never serve price queries don't load numpy
+    from catalogue_snapshot import get_catalogue_snapshot
+
+    try:
+        snapshot = get_catalogue_snapshot()
+        if snapshot is None:
+            return {"products": [], "error": "catalogue snapshot not synced"}
+        if by_market:
+            return {"query": q, "by_market": snapshot.cheapest_by_market(q or None)}
+        return {"query": q, "products": snapshot.cheapest(q or None, market=market, k=k)}
+    except Exception as e:
+        logger.exception("Error querying catalogue snapshot: %s", e)
         return {"products": [], "error": str(e)}
-    
@@ -0,0 +1,150 @@
+"""
+Opt-in sampling profiler and pipeline stage tags.
+
+SamplingProfiler walks sys._current_frames() from a background thread and
+aggregates the stacks in the "folded" format read by flamegraph.pl,
+speedscope and inferno:
+
+    stage:rank;main.py:handle_chat;chatbot_service.py:llm_filter_and_score_products 12
+
+Pipeline functions are tagged with `@stage("rank")` (or `with stage(...)`);
+the tags active on a sampled thread become the root frames of its stacks.
+Everything is pure Python, so the same profiles can be taken on a live worker
+or offline against stubbed Gemini/Weaviate calls.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+# Stage tags per thread id. Read by the sampler thread, so they can't be thread-locals.
+_thread_stages: Dict[int, List[str]] = {}
+
+# Recent latency per stage: name -> [ewma_seconds, last_update]
+STAGE_LATENCY_ALPHA = 0.2
+_stage_latency: Dict[str, List[float]] = {}
+
+# Leaf frames of threads that are parked, not working
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("selectors.py", "select"),
+}
+
+@contextmanager
+def stage(name: str):
+    """
+    Tag the current thread with a pipeline stage and record how long it took.
+    Works as a decorator too.
+    """
+    thread_id = threading.get_ident()
+    stages = _thread_stages.setdefault(thread_id, [])
+    stages.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages.pop()
+        if not stages:
+            # Pool threads come and go; don't keep an entry per thread id ever seen
+            del _thread_stages[thread_id]
+        _record_stage_latency(name, time.perf_counter() - start)
+
+def _record_stage_latency(name: str, seconds: float) -> None:
+    entry = _stage_latency.get(name)
+    if entry is None:
+        _stage_latency[name] = [seconds, time.monotonic()]
+    else:
+        # Unlocked read-modify-write: a lost update only skews one EWMA step
+        entry[0] += STAGE_LATENCY_ALPHA * (seconds - entry[0])
+        entry[1] = time.monotonic()
+
+def stage_latencies(max_age: float = 30.0) -> Dict[str, float]:
+    """
+    EWMA latency per stage, leaving out stages that haven't run for max_age seconds
+    """
+    now = time.monotonic()
+    return {name: ewma for name, (ewma, updated) in list(_stage_latency.items()) if now - updated <= max_age}
+
+def current_stage() -> Optional[str]:
+    stages = _thread_stages.get(threading.get_ident())
+    return stages[-1] if stages else None
+
+class SamplingProfiler:
+    """
+    Samples the stacks of the given threads (all threads if None) every interval seconds.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_ids: Optional[Iterable[int]] = None,
+                 include_idle: bool = False, max_depth: int = 64):
+        self.interval = interval
+        self.thread_ids = set(thread_ids) if thread_ids is not None else None
+        self.include_idle = include_idle
+        self.max_depth = max_depth
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self._started = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SamplingProfiler":
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> "SamplingProfiler":
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        return self
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self._sample(own_id)
+
+    def _sample(self, own_id: int) -> None:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                continue
+            if not self.include_idle and (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                continue
+
+            frames = []
+            while frame is not None and len(frames) < self.max_depth:
+                code = frame.f_code
+                frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            frames.reverse()
+
+            stages = ["stage:" + name for name in _thread_stages.get(thread_id, ())]
+            self.stacks[";".join(stages + frames)] += 1
+        self.samples += 1
+
+    def folded(self) -> str:
+        """Stacks in folded format, one 'frame;frame;... count' line per stack."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+@contextmanager
+def profile_current_thread(enabled: bool = True, interval: float = 0.005):
+    """
+    Profile the calling thread for the duration of the block. Yields None when
+    disabled, so callers pay nothing unless a profile was requested.
+    Work handed to thread pools shows up as waiting frames, not as their stacks.
+    """
+    if not enabled:
+        yield None
+        return
+    profiler = SamplingProfiler(interval=interval, thread_ids=[threading.get_ident()], include_idle=True).start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
@@ -0,0 +1,294 @@
+"""
+Local pre-classifier and memo for the routing questions asked before search:
+
+    answer   should we answer this at all? (should_answer_question)
+    search   does it need a product search? (needs_product_search)
+
+Each query is first checked against keyword and price-pattern rules, then a
+memo of earlier decisions keyed by the normalized query, then a small naive
+Bayes model. Only queries none of them decide confidently go to Gemini.
+Gemini's decisions are memoized and logged to the "query_classifier.decisions"
+logger. The model is trained offline from those logs:
+
+    python query_classifier.py app.log [more.log ...] [--out query_classifier_model.json]
+
+Queries that refer back to the conversation ("bunlar", "peki ya ...") depend
+on the context, so they skip the memo and the model.
+
+Environment:
+    CLASSIFIER_MODEL_PATH       trained model, optional (default query_classifier_model.json)
+    CLASSIFIER_MIN_CONFIDENCE   model posterior needed to skip Gemini (default 0.9)
+    CLASSIFIER_MEMO_SIZE        memoized queries per task (default 10000)
+    CLASSIFIER_MEMO_TTL_SECONDS how long a memoized decision is reused (default 3600)
+"""
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from turkish_text import INFLECTION_SUFFIXES, has_keyword, is_noun_form
+
+logger = logging.getLogger(__name__)
+# Fixed name: the training CLI runs this module as __main__ and filters logs by it
+decision_logger = logging.getLogger("query_classifier.decisions")
+
+TASKS = ("answer", "search")
+DEFAULT_MODEL_PATH = os.environ.get("CLASSIFIER_MODEL_PATH", "query_classifier_model.json")
+FEATURE_STEM_LENGTH = 5
+
+GREETING_WORDS = {
+    "merhaba", "merhabalar", "selam", "selamlar", "slm", "mrb", "günaydın", "iyi", "akşamlar",
+    "geceler", "günler", "teşekkürler", "teşekkür", "ederim", "sağol", "sağolun", "eyvallah",
+    "hoşça", "kal", "kalın", "görüşürüz", "nasılsın", "naber", "hey", "tamam", "ok"
+}
+# "kaç" is left out: "kaç kalori" is a nutrition question, "kaç TL" is caught by "tl"
+PRICE_WORDS = ("fiyat", "tl", "lira", "para", "ucuz", "pahalı", "indirim", "kampanya", "market", "nerede")
+COOKING_WORDS = ("tarif", "pişir", "yapılır", "kalori", "vitamin", "protein", "sağlıklı", "besin", "saklan")
+OFF_TOPIC_WORDS = (
+    "futbol", "maç", "siyaset", "seçim", "hava", "yağmur", "film", "dizi", "şarkı", "oyun", "python",
+    "kod", "bitcoin", "borsa", "araba", "telefon", "bilgisayar", "tatil", "uçak", "otel"
+)
+# Last letter of a possessive compound head: "uçak kurabiyesi" is a cookie
+POSSESSIVE_ENDINGS = ("ı", "i", "u", "ü")
+# Words that make a query depend on the conversation so far
+REFERENCE_WORDS = {
+    "bu", "şu", "o", "bunlar", "bunları", "bunların", "bunlardan", "bunu", "bunun", "onlar",
+    "onları", "onların", "onlardan", "onu", "onun", "şunlar", "hangisi", "hangisini", "peki",
+    "ya", "aynı", "başka", "diğer", "öbür", "önceki", "yukarıdaki", "daha"
+}
+
+def _has_prefix(words: Sequence[str], prefixes: Iterable[str]) -> bool:
+    """
+    True if a word starts with one of the prefixes. Prefixes of two letters or
+    less must match a whole word, so "un" doesn't match "unuttum".
+    """
+    return any(word == prefix or (len(prefix) > 2 and word.startswith(prefix))
+               for prefix in prefixes for word in words)
+
+def _is_off_topic(words: Sequence[str]) -> bool:
+    """
+    True if an off-topic word is used bare or inflected ("maçı", "filmler"), not
+    derived ("kodlu", "oyuncak") or as the modifier of a compound ("uçak kurabiyesi").
+    """
+    for i, word in enumerate(words):
+        if not any(is_noun_form(word, keyword, INFLECTION_SUFFIXES) for keyword in OFF_TOPIC_WORDS):
+            continue
+        next_word = words[i + 1] if i + 1 < len(words) else ""
+        if word in OFF_TOPIC_WORDS and next_word.endswith(POSSESSIVE_ENDINGS):
+            continue
+        return True
+    return False
+
+def features(words: Sequence[str]) -> List[str]:
+    """Prefix-stemmed tokens used by the naive Bayes model."""
+    return [word[:FEATURE_STEM_LENGTH] for word in words]
+
+class NaiveBayesModel:
+    """
+    Multinomial naive Bayes with add-one smoothing, one yes/no model per task.
+    """
+
+    def __init__(self, tasks: Dict[str, Dict]):
+        self.tasks = tasks
+        self._vocabularies = {task: set(params["vocabulary"]) for task, params in tasks.items()}
+
+    @classmethod
+    def load(cls, path: str) -> Optional["NaiveBayesModel"]:
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f)["tasks"])
+
+    @classmethod
+    def train(cls, examples: Iterable[Dict]) -> "NaiveBayesModel":
+        """Train from decision records: {"task", "query", "decision"}."""
+        counts = {task: {"true": Counter(), "false": Counter()} for task in TASKS}
+        documents = {task: Counter() for task in TASKS}
+        for example in examples:
+            task, label = example["task"], "true" if example["decision"] else "false"
+            if task not in counts:
+                continue
+            counts[task][label].update(features(example["query"].split()))
+            documents[task][label] += 1
+
+        tasks = {}
+        for task in TASKS:
+            total_documents = sum(documents[task].values())
+            if not total_documents:
+                continue
+            vocabulary = set(counts[task]["true"]) | set(counts[task]["false"])
+            classes = {}
+            for label in ("true", "false"):
+                total = sum(counts[task][label].values()) + len(vocabulary)
+                classes[label] = {
+                    "prior": math.log((documents[task][label] + 1) / (total_documents + 2)),
+                    "unknown": math.log(1 / total),
+                    "tokens": {token: math.log((count + 1) / total) for token, count in counts[task][label].items()},
+                }
+            tasks[task] = {"examples": total_documents, "vocabulary": sorted(vocabulary), "classes": classes}
+        return cls(tasks)
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"tasks": self.tasks}, f, ensure_ascii=False)
+
+    def predict(self, task: str, words: Sequence[str]) -> Optional[float]:
+        """
+        Probability that the answer is yes, or None if the model knows none of the words
+        """
+        model = self.tasks.get(task)
+        if model is None:
+            return None
+        tokens = [token for token in features(words) if token in self._vocabularies[task]]
+        if not tokens:
+            return None
+
+        scores = {}
+        for label, params in model["classes"].items():
+            scores[label] = params["prior"] + sum(params["tokens"].get(token, params["unknown"]) for token in tokens)
+        top = max(scores.values())
+        exp = {label: math.exp(score - top) for label, score in scores.items()}
+        return exp["true"] / sum(exp.values())
+
+class QueryClassifier:
+    """
+    Decides routing questions locally where it can. Thread-safe.
+    """
+
+    def __init__(self, product_keywords: Iterable[str], model_path: Optional[str] = DEFAULT_MODEL_PATH,
+                 min_confidence: float = 0.9, memo_size: int = 10000, memo_ttl: float = 3600.0):
+        self.product_keywords = tuple(product_keywords)
+        self.model = NaiveBayesModel.load(model_path) if model_path else None
+        self.min_confidence = min_confidence
+        self.memo_size = memo_size
+        self.memo_ttl = memo_ttl
+
+        self._lock = threading.Lock()
+        self._memo: Dict[str, "OrderedDict[str, tuple]"] = {task: OrderedDict() for task in TASKS}
+        self._stats = {task: {"rule": 0, "memo": 0, "model": 0, "llm": 0} for task in TASKS}
+        if self.model is not None:
+            logger.info("Loaded query classifier model from %s", model_path)
+
+    def depends_on_context(self, words: Sequence[str], conversation_context: str) -> bool:
+        return bool(conversation_context.strip()) and any(word in REFERENCE_WORDS for word in words)
+
+    def _rule(self, task: str, words: Sequence[str]) -> Optional[bool]:
+        if not words:
+            return None
+        if all(word in GREETING_WORDS for word in words):
+            return task == "answer"
+
+        has_product = has_keyword(words, self.product_keywords)
+        asks_price = _has_prefix(words, PRICE_WORDS)
+        if task == "answer":
+            if has_product:
+                return True
+            # "streç film fiyatı" is shopping even though "film" is off-topic
+            if not asks_price and _is_off_topic(words):
+                return False
+            return None
+
+        if _has_prefix(words, COOKING_WORDS) and not asks_price:
+            return False
+        if has_product and asks_price:
+            return True
+        return None
+
+    def _count(self, task: str, source: str) -> None:
+        with self._lock:
+            self._stats[task][source] += 1
+
+    def _memoize(self, task: str, key: str, decision: bool) -> None:
+        with self._lock:
+            memo = self._memo[task]
+            memo[key] = (decision, time.monotonic())
+            memo.move_to_end(key)
+            while len(memo) > self.memo_size:
+                memo.popitem(last=False)
+
+    def decide(self, task: str, words: Sequence[str], conversation_context: str = "") -> Optional[bool]:
+        """
+        Local decision for the task, or None if Gemini should decide
+        """
+        decision = self._rule(task, words)
+        if decision is not None:
+            self._count(task, "rule")
+            return decision
+
+        if self.depends_on_context(words, conversation_context):
+            self._count(task, "llm")
+            return None
+
+        key = " ".join(words)
+        with self._lock:
+            cached = self._memo[task].get(key)
+            if cached is not None and time.monotonic() - cached[1] <= self.memo_ttl:
+                self._memo[task].move_to_end(key)
+                self._stats[task]["memo"] += 1
+                return cached[0]
+
+        if self.model is not None:
+            probability = self.model.predict(task, words)
+            if probability is not None and max(probability, 1 - probability) >= self.min_confidence:
+                decision = probability >= 0.5
+                self._memoize(task, key, decision)
+                self._count(task, "model")
+                return decision
+
+        self._count(task, "llm")
+        return None
+
+    def record(self, task: str, words: Sequence[str], conversation_context: str, decision: bool) -> None:
+        """
+        Memoize and log a decision made by Gemini, unless it depended on the context
+        """
+        if self.depends_on_context(words, conversation_context):
+            return
+        query = " ".join(words)
+        self._memoize(task, query, decision)
+        decision_logger.info("Classification decision", extra={"payload": {"task": task, "query": query, "decision": decision}})
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            result = {"model_loaded": self.model is not None, "memo_size": {task: len(memo) for task, memo in self._memo.items()}}
+            for task, stats in self._stats.items():
+                total = sum(stats.values())
+                result[task] = {
+                    **stats,
+                    "local_hit_rate": (total - stats["llm"]) / total if total else 0.0,
+                    "fallthrough_rate": stats["llm"] / total if total else 0.0,
+                }
+            return result
+
+def read_decisions(paths: Iterable[str]) -> Iterable[Dict]:
+    """Decision records from JSON-lines logs written by structured_logging."""
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("logger") == decision_logger.name and isinstance(entry.get("payload"), dict):
+                    yield entry["payload"]
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    out = DEFAULT_MODEL_PATH
+    if "--out" in args:
+        i = args.index("--out")
+        out = args[i + 1]
+        del args[i:i + 2]
+    if not args:
+        sys.exit("usage: python query_classifier.py LOG_FILE [LOG_FILE ...] [--out MODEL_PATH]")
+
+    model = NaiveBayesModel.train(read_decisions(args))
+    model.save(out)
+    for task, params in model.tasks.items():
+        print(f"{task}: {params['examples']} examples, {len(params['vocabulary'])} tokens")
+    print(f"Saved model to {out}")
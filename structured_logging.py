@@ -0,0 +1,148 @@
+"""
+Structured, non-blocking logging.
+
+Request threads only put records on a bounded in-memory queue; a
+QueueListener thread formats them as JSON lines and writes them to stdout.
+Each record carries the request id and the pipeline stage it was logged from.
+
+Verbose payloads (raw LLM responses, full error bodies) go through
+log_payload(). It logs at DEBUG and keeps only a sampled fraction, and it
+returns before doing any work when DEBUG is off.
+
+Environment:
+    LOG_LEVEL                  minimum level (default INFO)
+    LOG_PAYLOAD_SAMPLE_RATE    fraction of payload records kept (default 0.1)
+    LOG_QUEUE_SIZE             records buffered before new ones are dropped (default 10000)
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from profiling import current_stage
+
+PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+PAYLOAD_MAX_CHARS = 2000
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_queue_handler: Optional["DroppingQueueHandler"] = None
+
+@contextmanager
+def request_context(request_id: str):
+    """Attach request_id to every record logged in this block."""
+    token = request_id_var.set(request_id)
+    try:
+        yield
+    finally:
+        request_id_var.reset(token)
+
+class ContextFilter(logging.Filter):
+    """
+    Adds request_id and stage. Runs in the calling thread, before the record is queued.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.stage = current_stage()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in ("request_id", "stage"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            entry["payload"] = payload
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Never blocks the caller: when the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Keep the record intact for the JsonFormatter; only resolve the message
+        # and exception text, which may reference objects that change later.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure_logging(level: Optional[str] = None) -> None:
+    """
+    Route all logging through a background queue listener. Safe to call more than once.
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(maxsize=int(os.environ.get("LOG_QUEUE_SIZE", "10000")))
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    _queue_handler = DroppingQueueHandler(log_queue)
+    _queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel((level or os.environ.get("LOG_LEVEL", "INFO")).upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+def shutdown_logging() -> None:
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def dropped_records() -> int:
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+def log_payload(logger: logging.Logger, message: str, payload, *args) -> None:
+    """
+    Log a verbose payload at DEBUG, keeping only PAYLOAD_SAMPLE_RATE of them.
+    Costs a level check and nothing else when DEBUG is disabled.
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or random.random() >= PAYLOAD_SAMPLE_RATE:
+        return
+    text = str(payload)
+    if len(text) > PAYLOAD_MAX_CHARS:
+        text = text[:PAYLOAD_MAX_CHARS] + "…"
+    logger.debug(message, *args, extra={"payload": text})
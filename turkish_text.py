@@ -0,0 +1,45 @@
+"""
+Turkish text helpers shared by the chatbot, the query classifier and the
+catalogue snapshot.
+"""
+import re
+from typing import AbstractSet, Iterable, List, Sequence
+
+_TURKISH_LOWER = str.maketrans({"I": "ı", "İ": "i"})
+# Case ending written after an apostrophe on a proper noun ("Migros'ta", "BİM'de")
+_APOSTROPHE_SUFFIX = re.compile(r"['’]\w+")
+
+# Plural, possessive and case endings: "süt", "sütü", "sütler" are all milk
+INFLECTION_SUFFIXES = {
+    "lar", "ler", "ları", "leri", "ı", "i", "u", "ü", "yı", "yi", "yu", "yü", "sı", "si", "su", "sü",
+    "a", "e", "ya", "ye", "da", "de", "ta", "te", "dan", "den", "tan", "ten", "ın", "in", "un", "ün",
+    "nın", "nin", "nun", "nün", "ların", "lerin", "larda", "lerde", "lardan", "lerden"
+}
+# Endings a product keyword may carry in a query; "sütlü", "şekersiz" still ask about the product
+NOUN_SUFFIXES = INFLECTION_SUFFIXES | {
+    "lı", "li", "lu", "lü", "sız", "siz", "suz", "süz", "lık", "lik", "luk", "lük"
+}
+
+def normalize_turkish(text: str) -> str:
+    """
+    Lowercase with Turkish casing rules (I → ı, İ → i) and collapse whitespace
+    """
+    return " ".join(str(text).translate(_TURKISH_LOWER).lower().split())
+
+def split_words(text: str) -> List[str]:
+    """
+    Normalized words of the text, with suffixes after an apostrophe dropped
+    ("ŞOK'ta" -> "şok")
+    """
+    return re.findall(r"\w+", _APOSTROPHE_SUFFIX.sub("", normalize_turkish(text)))
+
+def is_noun_form(word: str, keyword: str, suffixes: AbstractSet[str] = NOUN_SUFFIXES) -> bool:
+    """
+    True if word is the keyword, bare or with one of the suffixes ("elmalar", "sütü"),
+    so "yağ" doesn't match "yağmur" or "yağacak".
+    """
+    return word == keyword or (word.startswith(keyword) and word[len(keyword):] in suffixes)
+
+def has_keyword(words: Sequence[str], keywords: Iterable[str]) -> bool:
+    """True if any word is a noun form of any keyword."""
+    return any(is_noun_form(word, keyword) for keyword in keywords for word in words)
@@ -0,0 +1,237 @@
+"""
+Weaviate API client: product search, paged product fetches and the collection
+list. Needs no Gemini key, so offline tools like the catalogue sync can use it.
+"""
+import contextvars
+import logging
+import threading
+from collections import deque
+from typing import Dict, Iterator, List, Optional
+
+from structured_logging import log_payload
+
+# NOTE: `requests` is imported lazily (see get_http_session); importing it
+# eagerly dominated cold start on Render.
+
+logger = logging.getLogger(__name__)
+
+# Weaviate API Configuration
+USE_LOCAL_WEAVIATE = False  # Changed to False to use production
+LOCAL_WEAVIATE_URL = "http://127.0.0.1:8001"  # Local testing URL
+PRODUCTION_WEAVIATE_URL = "https://priceless-weaviate-production.up.railway.app"  # Production URL
+
+WEAVIATE_API_URL = LOCAL_WEAVIATE_URL if USE_LOCAL_WEAVIATE else PRODUCTION_WEAVIATE_URL
+
+DEFAULT_COLLECTION = "SupermarketProducts3"
+
+# HTTP connection pool for Weaviate requests
+WEAVIATE_POOL_SIZE = 16
+
+# Knowledge base pagination: page size and max pages fetched concurrently
+KNOWLEDGE_BASE_BATCH_SIZE = 100
+KNOWLEDGE_BASE_MAX_CONCURRENCY = 4
+
+_session_lock = threading.Lock()
+_http_session = None
+
+def get_http_session():
+    """
+    Return the shared requests session used for all Weaviate calls.
+    Reusing one session keeps TCP/TLS connections alive between requests.
+    """
+    global _http_session
+    if _http_session is None:
+        with _session_lock:
+            if _http_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=WEAVIATE_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _http_session = session
+    return _http_session
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """
+    executor.submit that carries the caller's context (request id, request start)
+    into the worker thread
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def search_products_weaviate(search_term: str, collection: str = DEFAULT_COLLECTION, limit: int = 20, timeout: float = 30) -> List[Dict]:
+    """
+    Search products using Weaviate semantic search endpoint
+    """
+    import requests
+    
+    url = f"{WEAVIATE_API_URL}/search"
+    params = {
+        "query": search_term,
+        "collection": collection,
+        "limit": limit
+    }
+    
+    logger.debug("Searching Weaviate for '%s' in collection '%s' (%s)", search_term, collection, url)
+    
+    try:
+        response = get_http_session().get(url, params=params, timeout=timeout)
+        
+        if response.status_code == 200:
+            products = response.json()
+            if isinstance(products, list):
+                logger.debug("Weaviate returned %d products from '%s'", len(products), collection)
+                return products
+            else:
+                logger.error("Invalid response format")
+                return []
+        else:
+            logger.error("Search failed with status %s", response.status_code)
+            log_payload(logger, "Search error response", response.text)
+            return []
+            
+    except requests.exceptions.Timeout:
+        logger.error("Search request timed out")
+        return []
+    except requests.exceptions.RequestException as e:
+        logger.error("Search request failed: %s", e)
+        return []
+    except Exception as e:
+        logger.exception("Unexpected error in search: %s", e)
+        return []
+
+class WeaviateFetchError(Exception):
+    """Raised instead of returning a fallback when the caller asked for fetch errors."""
+
+def get_products_from_weaviate(collection: str = DEFAULT_COLLECTION, offset: int = 0, limit: int = 100,
+                               raise_errors: bool = False) -> List[Dict]:
+    """
+    Get products from Weaviate collection using the chatbot endpoint.
+    Errors return an empty page, or raise WeaviateFetchError with raise_errors.
+    """
+    import requests
+    
+    url = f"{WEAVIATE_API_URL}/chatbot/products"
+    params = {
+        "collection": collection,
+        "offset": offset,
+        "limit": limit
+    }
+    
+    logger.debug("Fetching products from collection '%s' at offset %d (%s)", collection, offset, url)
+    
+    try:
+        response = get_http_session().get(url, params=params, timeout=30)  # Increased timeout
+        
+        if response.status_code == 200:
+            products = response.json()
+            if isinstance(products, list):
+                logger.debug("Retrieved %d products", len(products))
+                return products
+            else:
+                logger.error("Invalid response format")
+                error = "invalid response format"
+        else:
+            logger.error("Fetch failed with status %s", response.status_code)
+            log_payload(logger, "Fetch error response", response.text)
+            error = f"status {response.status_code}"
+            
+    except requests.exceptions.Timeout:
+        logger.error("Product fetch request timed out")
+        error = "timed out"
+    except requests.exceptions.RequestException as e:
+        logger.error("Product fetch request failed: %s", e)
+        error = str(e)
+    except Exception as e:
+        logger.exception("Unexpected error in product fetch: %s", e)
+        error = str(e)
+    
+    if raise_errors:
+        raise WeaviateFetchError(f"fetching '{collection}' at offset {offset} failed: {error}")
+    return []
+
+def get_available_collections(raise_errors: bool = False) -> List[str]:
+    """
+    Get list of available Weaviate collections.
+    Errors fall back to [DEFAULT_COLLECTION], or raise WeaviateFetchError with raise_errors.
+    """
+    import requests
+    
+    url = f"{WEAVIATE_API_URL}/chatbot/collections"
+    logger.debug("Fetching available collections (%s)", url)
+    
+    try:
+        response = get_http_session().get(url, timeout=30)  # Increased timeout
+        
+        if response.status_code == 200:
+            data = response.json()
+            collections = data.get("collections", [])
+            if collections:
+                logger.info("Found collections: %s", collections)
+                return collections
+            else:
+                logger.warning("No collections found")
+                error = "no collections found"
+        else:
+            logger.error("Collections fetch failed with status %s", response.status_code)
+            log_payload(logger, "Collections fetch error response", response.text)
+            error = f"status {response.status_code}"
+            
+    except requests.exceptions.Timeout:
+        logger.error("Collections request timed out")
+        error = "timed out"
+    except requests.exceptions.RequestException as e:
+        logger.error("Collections request failed: %s", e)
+        error = str(e)
+    except Exception as e:
+        logger.exception("Unexpected error in collections fetch: %s", e)
+        error = str(e)
+    
+    if raise_errors:
+        raise WeaviateFetchError(f"fetching collections failed: {error}")
+    return [DEFAULT_COLLECTION]  # fallback
+
+def iter_products(collection: str = DEFAULT_COLLECTION, limit: Optional[int] = None,
+                  batch_size: int = KNOWLEDGE_BASE_BATCH_SIZE,
+                  max_concurrency: int = KNOWLEDGE_BASE_MAX_CONCURRENCY,
+                  raise_errors: bool = False) -> Iterator[Dict]:
+    """
+    Stream products from a collection page by page.
+    Up to max_concurrency pages are fetched at once; products are still yielded
+    in offset order, and only the in-flight pages are held in memory.
+    A failed page normally ends the stream early; with raise_errors it raises
+    WeaviateFetchError, so callers that need the full collection can tell.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="kb-page")
+    pending = deque()  # (requested size, future) in offset order
+    next_offset = 0
+    
+    def submit_next_page() -> bool:
+        nonlocal next_offset
+        if limit is not None and next_offset >= limit:
+            return False
+        size = batch_size if limit is None else min(batch_size, limit - next_offset)
+        future = submit_in_context(executor, get_products_from_weaviate, collection=collection, offset=next_offset,
+                                   limit=size, raise_errors=raise_errors)
+        pending.append((size, future))
+        next_offset += size
+        return True
+    
+    try:
+        for _ in range(max_concurrency):
+            if not submit_next_page():
+                break
+        
+        while pending:
+            size, future = pending.popleft()
+            batch = future.result()
+            yield from batch
+            
+            if len(batch) < size:  # Last page; anything still in flight is past the end
+                break
+            submit_next_page()
+    finally:
+        # Also runs when the consumer stops early, e.g. a closed streaming response
+        executor.shutdown(wait=False, cancel_futures=True)